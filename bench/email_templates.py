@@ -0,0 +1,86 @@
+"""
+Render time of the welcome / warning / removal emails, built-in and custom
+templates, against the daemon.py of an earlier revision (by default the one
+before email templates were compiled and cached). Output of both is checked
+to be identical before timing.
+
+Run from the repository root:  python bench/email_templates.py [BASELINE_REV] [N]
+"""
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+NAMES = ["Alice <&> O'Neil", "bob", "Zoë"]
+CUSTOM = "<html><body><p>Hi {display_name}, {days} / {days_left}</p>" + "x" * 20000 + "</body></html>"
+
+
+def default_baseline():
+    out = subprocess.run(["git", "log", "-1", "--format=%H", "--fixed-strings",
+                          "--grep=Compile email templates once"],
+                         cwd=ROOT, check=True, capture_output=True, text=True).stdout.strip()
+    if not out:
+        raise SystemExit("baseline commit not found; pass BASELINE_REV")
+    return out + "^"
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def render_all(module, n):
+    t = time.perf_counter()
+    for i in range(n):
+        module.welcome_email_html(f"user{i}")
+        module.warn_email_html(f"user{i}", 27)
+        module.removal_email_html(f"user{i}")
+    return time.perf_counter() - t
+
+
+def assert_identical(old, new):
+    for name in NAMES:
+        assert old.welcome_email_html(name) == new.welcome_email_html(name)
+        assert old.warn_email_html(name, 27) == new.warn_email_html(name, 27)
+        assert old.removal_email_html(name) == new.removal_email_html(name)
+
+
+def main(baseline, n):
+    with tempfile.TemporaryDirectory() as directory:
+        source = subprocess.run(["git", "show", f"{baseline}:daemon.py"],
+                                cwd=ROOT, check=True, capture_output=True).stdout
+        baseline_path = os.path.join(directory, "baseline_daemon.py")
+        with open(baseline_path, "wb") as f:
+            f.write(source)
+        old = load_module("baseline_daemon", baseline_path)
+        new = load_module("daemon", os.path.join(ROOT, "daemon.py"))
+
+        template_dir = os.path.join(directory, "email_templates")
+        os.makedirs(template_dir)
+        old.CUSTOM_TEMPLATE_DIR = new.CUSTOM_TEMPLATE_DIR = template_dir
+        new.log = old.log = lambda message: None
+
+        print(f"baseline: {baseline}")
+        for label in ("built-in", "custom"):
+            if label == "custom":
+                for name in ("welcome", "warning", "removal"):
+                    with open(os.path.join(template_dir, f"{name}.html"), "w") as f:
+                        f.write(CUSTOM)
+                new.email_templates.invalidate()
+            assert_identical(old, new)
+            old_secs, new_secs = render_all(old, n), render_all(new, n)
+            print(f"{label:>8} templates, {n} x (welcome + warn + removal): "
+                  f"baseline {old_secs:.2f}s ({old_secs / n / 3 * 1e6:.1f}us/email)   "
+                  f"current {new_secs:.2f}s ({new_secs / n / 3 * 1e6:.1f}us/email)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(args[0] if args else default_baseline(), int(args[1]) if len(args) > 1 else 10000)
@@ -0,0 +1,85 @@
+"""
+Parse time and peak memory of plex_get_users() on a synthetic plex.tv users
+document, against the previous parse-the-whole-body approach
+(ElementTree.fromstring on response.text, one dict per user).
+
+Run from the repository root:  python bench/plex_users_xml.py [N ...]
+"""
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import daemon  # noqa: E402
+
+
+def users_xml(n):
+    parts = [f'<?xml version="1.0" encoding="UTF-8"?><MediaContainer friendlyName="myPlex" '
+             f'identifier="com.plexapp.plugins.myplex" machineIdentifier="abc" totalSize="{n}" size="{n}">']
+    for i in range(n):
+        parts.append(
+            f'<User id="{10000000 + i}" title="User Number {i}" username="user{i}" email="user{i}@example.com" '
+            f'recommendationsPlaylistId="" thumb="https://plex.tv/users/{i:032x}/avatar?c=1700000000" '
+            f'protected="0" home="0" allowTuners="0" allowSync="1" allowCameraUpload="0" allowChannels="0" '
+            f'allowSubtitleAdmin="0" filterAll="" filterMovies="" filterMusic="" filterPhotos="" '
+            f'filterTelevision="" restricted="0" createdAt="2023-01-01T00:00:00Z">'
+            f'<Server id="{i}" serverId="1" machineIdentifier="abc" name="Srv" lastSeenAt="1700000000" '
+            f'numLibraries="4" allLibraries="1" owned="0" pending="0"/></User>')
+    parts.append("</MediaContainer>")
+    return "".join(parts).encode()
+
+
+class FakeResponse:
+    """Just enough of requests.Response for both parsers."""
+
+    def __init__(self, body):
+        self._body = body
+
+    @property
+    def text(self):
+        return self._body.decode()
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self._body), chunk_size):
+            yield self._body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def parse_whole_body(r):
+    root = ET.fromstring(r.text)
+    return [{k: u.attrib.get(k) for k in daemon.PLEX_USER_FIELDS} for u in root.findall("User")]
+
+
+def parse_streamed(r):
+    daemon.safe_request = lambda *a, **kw: r
+    return daemon.plex_get_users()
+
+
+def measure(fn, body):
+    gc.collect()
+    tracemalloc.start()
+    t = time.perf_counter()
+    users = fn(FakeResponse(body))
+    elapsed = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return users, elapsed, peak
+
+
+def main(sizes):
+    for n in sizes:
+        body = users_xml(n)
+        old, old_secs, old_peak = measure(parse_whole_body, body)
+        new, new_secs, new_peak = measure(parse_streamed, body)
+        assert [u.to_dict() for u in new] == old
+        print(f"{n:>7} users: whole body {old_secs * 1000:7.0f} ms / {old_peak / 1e6:6.1f} MB peak   "
+              f"streamed {new_secs * 1000:7.0f} ms / {new_peak / 1e6:6.1f} MB peak")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 50000])
@@ -0,0 +1,108 @@
+"""
+Delivery time for a batch of warning emails through SmtpPool, against a new
+STARTTLS + login session per message (how send_email worked before the pool).
+
+The relay is a local aiosmtpd server with STARTTLS and AUTH required, using a
+throwaway self-signed certificate made with the openssl CLI. aiosmtpd is not
+a runtime dependency:  pip install aiosmtpd
+
+Run from the repository root:  python bench/smtp_pool.py [MESSAGES]
+"""
+import logging
+import os
+import smtplib
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from email.mime.text import MIMEText
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import daemon  # noqa: E402
+
+FROM = "autoprune@example.com"
+
+
+class CountingHandler:
+    delivered = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        CountingHandler.delivered += 1
+        return "250 OK"
+
+
+def tls_context(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_relay(context, port):
+    relay = Controller(CountingHandler(), hostname="127.0.0.1", port=port, tls_context=context,
+                       require_starttls=True, auth_require_tls=True,
+                       authenticator=lambda *a: AuthResult(success=True))
+    relay.start()
+    return relay
+
+
+def send_per_message_session(port, to_addr, subject, html):
+    msg = MIMEText(html, "html")
+    msg["Subject"] = subject
+    msg["From"] = FROM
+    msg["To"] = to_addr
+    with smtplib.SMTP("127.0.0.1", port, timeout=15) as s:
+        s.starttls()
+        s.login("bench", "bench")
+        s.sendmail(FROM, [to_addr], msg.as_string())
+
+
+def timed(send, count):
+    t = time.perf_counter()
+    for i in range(count):
+        send(f"user{i}@example.com")
+    return time.perf_counter() - t
+
+
+def main(count):
+    logging.disable(logging.CRITICAL)
+    daemon.log = lambda message: None
+    html = daemon.warn_email_html("Someone", 27)
+    with tempfile.TemporaryDirectory() as directory:
+        context, port = tls_context(directory), free_port()
+        os.environ.update(SMTP_HOST="127.0.0.1", SMTP_PORT=str(port), SMTP_USERNAME="bench",
+                          SMTP_PASSWORD="bench", SMTP_FROM=FROM)
+        relay = start_relay(context, port)
+        try:
+            old = timed(lambda to: send_per_message_session(port, to, "Inactivity notice", html), count)
+            new = timed(lambda to: daemon._smtp_send(to, "Inactivity notice", html), count)
+            print(f"{count} messages: per-message sessions {old:.2f}s ({count / old:.0f} msg/s)   "
+                  f"pooled {new:.2f}s ({count / new:.0f} msg/s)   pool {daemon.smtp_pool().status()}")
+
+            # A relay restart drops the pooled session; the next send must reconnect once
+            relay.stop()
+            relay = start_relay(context, port)
+            daemon._smtp_send("after-restart@example.com", "Inactivity notice", html)
+            print(f"after relay restart: pool {daemon.smtp_pool().status()}, "
+                  f"delivered {CountingHandler.delivered}/{2 * count + 1}")
+        finally:
+            daemon.smtp_pool().close_all()
+            relay.stop()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 80)
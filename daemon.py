@@ -1,8 +1,11 @@
-import os, time, json, signal, threading, smtplib, requests, math, random
+import os, time, json, signal, threading, smtplib, requests, math, random, hashlib, sqlite3, atexit, gzip, heapq
 import traceback
 import sys
 from datetime import datetime, timedelta, timezone
-from functools import wraps
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 # Ensure UTF-8 encoding for stdout to handle Unicode characters
 if sys.stdout.encoding != 'utf-8':
@@ -49,6 +52,122 @@ def retry_on_failure(max_retries=3, delay=2, backoff=2, exceptions=(Exception,))
     return decorator
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills `rate` tokens per second up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, n=1):
+        """Take n tokens if available. Returns 0 on success, else seconds until they would be."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            if self.rate <= 0:
+                return float("inf")
+            return (n - self.tokens) / self.rate
+
+    def acquire(self, n=1):
+        """Block until n tokens are available. Raises ValueError if they never will be (rate <= 0)."""
+        while True:
+            wait = self.try_acquire(n)
+            if wait == 0:
+                return
+            if wait == float("inf"):
+                raise ValueError(f"token bucket with rate {self.rate} can never refill {n} token(s)")
+            time.sleep(min(wait, 5))
+
+# ==================== HTTP SESSION POOL ====================
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_stats_lock = threading.Lock()
+_http_stats = {"checkouts": 0, "new_connections": 0}
+
+def _count_http(key):
+    with _http_stats_lock:
+        _http_stats[key] += 1
+
+class _CountingPoolMixin:
+    """Counts connection checkouts and fresh connections so pool reuse is observable."""
+    def _get_conn(self, timeout=None):
+        _count_http("checkouts")
+        return super()._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        _count_http("new_connections")
+        return super()._new_conn()
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+def http_session():
+    """
+    Shared keep-alive session used for every Plex, Tautulli and Discord call.
+    Pool sizes and transport retries come from HTTP_POOL_CONNECTIONS (hosts),
+    HTTP_POOL_MAXSIZE (connections per host), HTTP_RETRY_TOTAL and HTTP_RETRY_BACKOFF.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                retry = Retry(
+                    total=int(os.environ.get("HTTP_RETRY_TOTAL", "2")),
+                    backoff_factor=float(os.environ.get("HTTP_RETRY_BACKOFF", "0.5")),
+                    status_forcelist=(502, 503, 504),
+                    raise_on_status=False,
+                )
+                adapter = _CountingAdapter(
+                    pool_connections=int(os.environ.get("HTTP_POOL_CONNECTIONS", "10")),
+                    pool_maxsize=int(os.environ.get("HTTP_POOL_MAXSIZE", "10")),
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+def http_pool_stats():
+    """Connection pool counters: checkouts served from an idle keep-alive connection vs. new connections."""
+    with _http_stats_lock:
+        checkouts = _http_stats["checkouts"]
+        new_connections = _http_stats["new_connections"]
+    return {
+        "requests": checkouts,
+        "pool_hits": checkouts - new_connections,
+        "new_connections": new_connections,
+    }
+
+
 def safe_request(url, method='GET', timeout=10, **kwargs):
     """
     Safe HTTP request wrapper with timeout and error handling.
@@ -63,12 +182,7 @@ def safe_request(url, method='GET', timeout=10, **kwargs):
         Response object or None on failure
     """
     try:
-        if method.upper() == 'GET':
-            response = requests.get(url, timeout=timeout, **kwargs)
-        elif method.upper() == 'POST':
-            response = requests.post(url, timeout=timeout, **kwargs)
-        else:
-            response = requests.request(method, url, timeout=timeout, **kwargs)
+        response = http_session().request(method.upper(), url, timeout=timeout, **kwargs)
         
         response.raise_for_status()
         return response
@@ -157,11 +271,64 @@ DRY_RUN = os.environ.get("DRY_RUN", "true").lower() in ("true", "1", "yes")
 STATE_DIR  = "/app/state"
 STATE_FILE = f"{STATE_DIR}/state.json"
 DAEMON_CONTROL_FILE = f"{STATE_DIR}/daemon_control.json"
+WATCH_INDEX_FILE = f"{STATE_DIR}/watch_index.json"
 os.makedirs(STATE_DIR, exist_ok=True)
 
 stop_event = threading.Event()
 daemon_enabled = False  # Daemon starts disabled by default
 
+class WatcherWakeup:
+    """
+    Sleeps for the watcher loops that end early when monitoring is enabled or
+    disabled, the config is saved, a scan is requested or the daemon stops.
+    A loop takes generation() at the top of each pass and hands it to wait(),
+    so a notify() that lands mid-tick still cuts the following wait short.
+    """
+    WATCHERS = ("join", "inactive")
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._scan_requests = set()
+
+    def generation(self):
+        with self._cond:
+            return self._generation
+
+    def notify(self):
+        with self._cond:
+            self._generation += 1
+            self._cond.notify_all()
+
+    def request_scan(self, watchers=WATCHERS):
+        """Ask the given watchers to run a full tick now."""
+        with self._cond:
+            self._scan_requests.update(watchers)
+            self._generation += 1
+            self._cond.notify_all()
+
+    def take_scan(self, watcher):
+        """True (once) if a scan was requested for this watcher."""
+        with self._cond:
+            if watcher in self._scan_requests:
+                self._scan_requests.discard(watcher)
+                return True
+            return False
+
+    def wait(self, generation, timeout=None):
+        """Block for up to timeout seconds (None = until woken). Returns True if woken early."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._generation != generation or stop_event.is_set(), timeout)
+
+watcher_wakeup = WatcherWakeup()
+
+def watcher_interval(name, default):
+    """Tick interval (e.g. CHECK_INACTIVITY_SECS) as currently configured, in seconds."""
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
 def load_daemon_control():
     """Load daemon control state (enabled/disabled)"""
     if os.path.exists(DAEMON_CONTROL_FILE):
@@ -180,6 +347,7 @@ def save_daemon_control(enabled):
     with open(DAEMON_CONTROL_FILE, 'w') as f:
         json.dump({'enabled': enabled, 'updated_at': datetime.now(timezone.utc).isoformat()}, f, indent=2)
     log(f"[DAEMON] Monitoring {'ENABLED' if enabled else 'DISABLED'}")
+    watcher_wakeup.notify()
 
 # Initialize daemon state from file
 daemon_enabled = load_daemon_control()
@@ -187,51 +355,228 @@ daemon_enabled = load_daemon_control()
 from plexapi.myplex import MyPlexAccount
 import time
 
-def get_plex_account():
-    token = os.environ.get("PLEX_TOKEN")
+# MyPlex sign-ins are slow; keep one account (and its resource list) per token
+_plex_account_lock = threading.Lock()
+_plex_account_cache = {"token": None, "account": None, "resources": None}
+
+def get_plex_account(token=None):
+    """Cached MyPlexAccount for token (defaults to PLEX_TOKEN); signs in again only when the token changes."""
+    token = token or os.environ.get("PLEX_TOKEN")
     if not token:
         raise SystemExit("PLEX_TOKEN missing")
 
-    # Use keyword arg so plexapi does TOKEN auth (not username/password)
-    return MyPlexAccount(token=token)
+    with _plex_account_lock:
+        if _plex_account_cache["token"] != token or _plex_account_cache["account"] is None:
+            # Use keyword arg so plexapi does TOKEN auth (not username/password)
+            _plex_account_cache["account"] = MyPlexAccount(token=token)
+            _plex_account_cache["token"] = token
+            _plex_account_cache["resources"] = None
+        return _plex_account_cache["account"]
 
-def get_plex_server_resource(acct):
+def plex_account_resources(acct, refresh=False):
+    """acct.resources(), cached alongside the cached account."""
+    with _plex_account_lock:
+        if acct is not _plex_account_cache["account"]:
+            return acct.resources()
+        if refresh or _plex_account_cache["resources"] is None:
+            _plex_account_cache["resources"] = acct.resources()
+        return _plex_account_cache["resources"]
+
+def get_plex_server_resource(acct=None):
     target = os.environ.get("PLEX_SERVER_NAME")
     if not target:
         raise SystemExit("PLEX_SERVER_NAME missing")
+    if acct is None:
+        acct = get_plex_account()
 
     # Be tolerant: some plexapi versions expose .provides == "server"
     # others prefer .product == "Plex Media Server"
-    for res in acct.resources():
-        if (getattr(res, "provides", None) == "server" or getattr(res, "product", "") == "Plex Media Server"):
-            if res.name == target:
-                return res
+    # Retry once with a fresh listing in case the server was renamed or added
+    for refresh in (False, True):
+        for res in plex_account_resources(acct, refresh=refresh):
+            if (getattr(res, "provides", None) == "server" or getattr(res, "product", "") == "Plex Media Server"):
+                if res.name == target:
+                    return res
     raise SystemExit(f"Server '{target}' not found in Plex account resources")
 
 
 
-# ---- Utils ----
-def send_discord(message):
-    url = os.environ.get("DISCORD_WEBHOOK")
+# ==================== DISCORD ====================
+# Webhook posts go through one background dispatcher: callers only enqueue,
+# and queued messages are packed into embeds (up to 10 per call) and sent in
+# order, honouring Discord's rate-limit headers.
+
+DISCORD_BATCH_SECS = float(os.environ.get("DISCORD_BATCH_SECS", "1"))
+DISCORD_MAX_ATTEMPTS = int(os.environ.get("DISCORD_MAX_ATTEMPTS", "5"))
+DISCORD_QUEUE_MAX = max(1, int(os.environ.get("DISCORD_QUEUE_MAX", "1000")))
+DISCORD_MAX_EMBEDS = 10
+DISCORD_MAX_EMBED_CHARS = 6000  # combined text of all embeds in one message
+DISCORD_MAX_DESCRIPTION = 4096
+
+class DiscordDispatcher:
+    """
+    Per-webhook FIFO queues drained by a single worker thread. The worker waits
+    up to DISCORD_BATCH_SECS after the first queued message so that a burst
+    goes out as one call. A 429 (or X-RateLimit-Remaining: 0) pauses that
+    webhook until Retry-After / X-RateLimit-Reset-After has passed, or every
+    webhook when Discord flags the limit as global; the batch is resent without
+    counting an attempt. Network errors and 5xx replies are retried with
+    backoff up to DISCORD_MAX_ATTEMPTS; other 4xx replies drop the batch.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}  # webhook url -> [item]
+        self._paused_until = {}  # webhook url (or "*" for global) -> monotonic time
+        self._busy = False
+        self._thread = None
+        self.stats = {"queued": 0, "sent": 0, "calls": 0, "rate_limited": 0, "retried": 0, "dropped": 0}
+
+    def enqueue(self, url, text):
+        embed = {"description": text[:DISCORD_MAX_DESCRIPTION]}
+        with self._cond:
+            queue = self._queues.setdefault(url, [])
+            if sum(len(q) for q in self._queues.values()) >= DISCORD_QUEUE_MAX:
+                oldest = min((q for q in self._queues.values() if q), key=lambda q: q[0]["queued"])
+                oldest.pop(0)
+                self.stats["dropped"] += 1
+                log("[discord] queue full, dropped the oldest message")
+            queue.append({"embed": embed, "attempts": 0, "queued": time.monotonic()})
+            self.stats["queued"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="DiscordDispatcher")
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _take(self):
+        """Next (url, batch) ready to post, or (None, None, seconds to wait)."""
+        now = time.monotonic()
+        global_wait = self._paused_until.get("*", 0) - now
+        if global_wait > 0:
+            return None, None, global_wait
+        wait = None
+        for url, queue in self._queues.items():
+            if not queue:
+                continue
+            ready_in = max(self._paused_until.get(url, 0) - now,
+                           queue[0]["queued"] + DISCORD_BATCH_SECS - now if len(queue) < DISCORD_MAX_EMBEDS else 0)
+            if ready_in > 0:
+                wait = ready_in if wait is None else min(wait, ready_in)
+                continue
+            batch, chars = [], 0
+            while queue and len(batch) < DISCORD_MAX_EMBEDS:
+                size = len(queue[0]["embed"]["description"])
+                if batch and chars + size > DISCORD_MAX_EMBED_CHARS:
+                    break
+                batch.append(queue.pop(0))
+                chars += size
+            return url, batch, 0
+        return None, None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                url, batch, wait = self._take()
+                while batch is None:
+                    self._cond.wait(wait)
+                    url, batch, wait = self._take()
+                self._busy = True
+            try:
+                self._post(url, batch)
+            except Exception as e:
+                log(f"[discord] dispatcher error: {e}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _pause(self, key, secs):
+        with self._cond:
+            self._paused_until[key] = max(self._paused_until.get(key, 0), time.monotonic() + secs)
+
+    def _requeue(self, url, batch):
+        with self._cond:
+            self._queues[url][:0] = batch
+
+    def _post(self, url, batch):
+        try:
+            r = http_session().post(url, json={"embeds": [item["embed"] for item in batch]}, timeout=10)
+        except Exception as e:
+            self._retry(url, batch, f"exception: {e}")
+            return
+        with self._cond:
+            self.stats["calls"] += 1
+        if r.headers.get("X-RateLimit-Remaining") == "0":
+            self._pause(url, float(r.headers.get("X-RateLimit-Reset-After") or 1))
+        if r.status_code == 429:
+            try:
+                body = r.json()
+            except ValueError:
+                body = {}
+            retry_after = float(r.headers.get("Retry-After") or body.get("retry_after") or 1)
+            is_global = body.get("global") or r.headers.get("X-RateLimit-Global", "").lower() == "true"
+            self._pause("*" if is_global else url, retry_after)
+            self._requeue(url, batch)
+            with self._cond:
+                self.stats["rate_limited"] += 1
+            log(f"[discord] rate limited{' (global)' if is_global else ''}, resuming in {retry_after:.1f}s")
+        elif r.status_code in (200, 204):
+            with self._cond:
+                self.stats["sent"] += len(batch)
+        elif r.status_code >= 500:
+            self._retry(url, batch, f"error {r.status_code}")
+        else:
+            with self._cond:
+                self.stats["dropped"] += len(batch)
+            log(f"[discord] error {r.status_code}: {r.text}")
+
+    def _retry(self, url, batch, reason):
+        keep = []
+        for item in batch:
+            item["attempts"] += 1
+            if item["attempts"] < DISCORD_MAX_ATTEMPTS:
+                keep.append(item)
+        with self._cond:
+            self.stats["retried"] += len(keep)
+            self.stats["dropped"] += len(batch) - len(keep)
+        if keep:
+            delay = min(60, 2 ** keep[0]["attempts"])
+            self._pause(url, delay)
+            self._requeue(url, keep)
+            log(f"[discord] {reason}; retrying {len(keep)} message(s) in {delay}s")
+        else:
+            log(f"[discord] {reason}; dropped {len(batch)} message(s) after {DISCORD_MAX_ATTEMPTS} attempts")
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been posted (or dropped). Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._busy and not any(self._queues.values()), timeout)
+
+    def status(self):
+        now = time.monotonic()
+        with self._cond:
+            return dict(self.stats, pending=sum(len(q) for q in self._queues.values()),
+                        paused_for_secs={("global" if k == "*" else "webhook"): round(t - now, 1)
+                                         for k, t in self._paused_until.items() if t > now})
+
+discord_dispatcher = DiscordDispatcher()
+
+def send_discord(message, webhook=None):
+    """Queue a Discord webhook message; returns immediately."""
+    url = webhook or os.environ.get("DISCORD_WEBHOOK")
     if not url:
         log("[discord] webhook missing, skipping")
         return
-
-    payload = {"content": message}
-    try:
-        r = requests.post(url, json=payload, timeout=10)
-        if r.status_code != 204 and r.status_code != 200:
-            log(f"[discord] error {r.status_code}: {r.text}")
-    except Exception as e:
-        log(f"[discord] exception: {e}")
+    discord_dispatcher.enqueue(url, message)
 
 
 # ================================
 # Test Functions
 # ================================
 
-def test_discord_notifications():
-    """Send test Discord notifications for all event types"""
+def test_discord_notifications(webhook=None):
+    """Queue test Discord notifications for all event types (sent as one batch)"""
     log("[test] Sending Discord test notifications...")
     
     # Test 1: User Join
@@ -240,9 +585,8 @@ def test_discord_notifications():
         "**Test User** (test@example.com)\n"
         "ID: 99999999"
     )
-    send_discord(join_msg)
-    log("[test] User Join notification sent")
-    time.sleep(1)
+    send_discord(join_msg, webhook)
+    log("[test] User Join notification queued")
     
     # Test 2: Warning
     warning_msg = (
@@ -251,9 +595,8 @@ def test_discord_notifications():
         "Inactive for: 27 days\n"
         "Days until removal: 3"
     )
-    send_discord(warning_msg)
-    log("[test] Warning notification sent")
-    time.sleep(1)
+    send_discord(warning_msg, webhook)
+    log("[test] Warning notification queued")
     
     # Test 3: Removal
     removal_msg = (
@@ -261,80 +604,1864 @@ def test_discord_notifications():
         "**Test User** (test@example.com)\n"
         "Reason: Inactivity for 30 days"
     )
-    send_discord(removal_msg)
-    log("[test] Removal notification sent")
+    send_discord(removal_msg, webhook)
+    log("[test] Removal notification queued")
     
-    log("[test] ✅ All test notifications sent!")
+    log("[test] ✅ All test notifications queued!")
+
+
+# ==================== STATE STORAGE ====================
+# STATE_BACKEND=json keeps the original state.json document; STATE_BACKEND=journal
+# keeps state.json as a snapshot plus an append-only journal; STATE_BACKEND=sqlite
+# stores the same data in indexed SQLite tables (migrated once from state.json).
+# Email history is not part of the state document; see EMAIL HISTORY below.
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "json").lower()
+STATE_DB_FILE = f"{STATE_DIR}/state.db"
+STATE_RECORD_SECTIONS = ("welcomed", "warned", "removed", "departed")
+
+def _default_state():
+    return {
+        "welcomed": {}, 
+        "warned": {}, 
+        "removed": {}, 
+        "last_inactivity_scan": None,
+        "departed": {},  # Users who left Plex without being removed
+        "first_run_complete": False  # Flag for first-run setup
+    }
+
+def _normalize_state(state):
+    # Ensure new fields exist for backwards compatibility
+    for key, value in _default_state().items():
+        state.setdefault(key, value)
+    return state
+
+def _is_meta_key(key):
+    # "email_history" is the pre-split location of the email log; never store it as meta
+    return key not in STATE_RECORD_SECTIONS and key != "email_history" and not key.startswith("_")
+
+def _state_mirror(state):
+    """JSON text per record/meta key; diffed by _state_changes."""
+    mirror = {section: {str(uid): json.dumps(value, sort_keys=True) for uid, value in (state.get(section) or {}).items()}
+              for section in STATE_RECORD_SECTIONS}
+    mirror["meta"] = {k: json.dumps(v) for k, v in state.items() if _is_meta_key(k)}
+    return mirror
+
+def _state_changes(mirror, state):
+    """
+    Diff a full state dict against a mirror. Returns None when nothing changed,
+    else {"upserts": {section: [(uid, text)]}, "deletes": {section: [uid]},
+    "meta": [(key, text)]}.
+    """
+    upserts, deletes = {}, {}
+    for section in STATE_RECORD_SECTIONS:
+        current = mirror[section]
+        incoming = {str(uid): json.dumps(value, sort_keys=True)
+                    for uid, value in (state.get(section) or {}).items()}
+        upserts[section] = [(uid, text) for uid, text in incoming.items() if current.get(uid) != text]
+        deletes[section] = [uid for uid in current if uid not in incoming]
+    meta = [(k, json.dumps(v)) for k, v in state.items()
+            if _is_meta_key(k) and mirror["meta"].get(k) != json.dumps(v)]
+    if not (meta or any(upserts.values()) or any(deletes.values())):
+        return None
+    return {"upserts": upserts, "deletes": deletes, "meta": meta}
+
+def _apply_state_changes(mirror, changes):
+    for section in STATE_RECORD_SECTIONS:
+        mirror[section].update(changes["upserts"][section])
+        for uid in changes["deletes"][section]:
+            mirror[section].pop(uid, None)
+    mirror["meta"].update(changes["meta"])
+
+def _state_from_mirror(mirror):
+    state = _default_state()
+    for section in STATE_RECORD_SECTIONS:
+        state[section] = {uid: json.loads(text) for uid, text in mirror[section].items()}
+    for key, text in mirror["meta"].items():
+        state[key] = json.loads(text)
+    return state
+
+class JsonStateStore:
+    """The original layout: one state.json document, rewritten in full on every save."""
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return _default_state()
+        with open(self.path, "r") as f:
+            state = json.load(f)
+        _import_legacy_emails(state.pop("email_history", None))
+        return _normalize_state(state)
+
+    def save(self, state):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def replace(self, state):
+        self.save(_normalize_state(state))
+
+class SqliteStateStore:
+    """
+    State in SQLite (WAL): one table per record section keyed by user id with an
+    indexed updated_at and a meta table for scalar keys. The email_history table
+    lives in the same database but is owned by SqliteEmailHistory.
+    save() diffs against an in-memory mirror of the database and writes only the
+    rows that changed, so its I/O is O(changed rows) rather than O(file).
+    """
+
+    def __init__(self, path=STATE_DB_FILE, json_path=STATE_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._migrate_json(json_path)
+        self._load_mirror()
+
+    def _create_schema(self):
+        for section in STATE_RECORD_SECTIONS:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {section} ("
+                               "user_id TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at TEXT NOT NULL)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{section}_updated_at ON {section}(updated_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS email_history ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, recipient TEXT, "
+                           "subject TEXT, status TEXT, error TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_email_history_timestamp ON email_history(timestamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_email_history_recipient ON email_history(recipient)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
 
+    def _migrate_json(self, json_path):
+        """One-shot import of an existing state.json; the file is kept as state.json.migrated."""
+        if self._conn.execute("SELECT 1 FROM meta WHERE key = '_migrated_from_json'").fetchone():
+            return
+        with self._lock:
+            state, emails = None, []
+            if os.path.exists(json_path):
+                with open(json_path, "r") as f:
+                    state = json.load(f)
+                emails = state.pop("email_history", None) or []
+                state = _normalize_state(state)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if state is not None:
+                    self._write_all(state)
+                    self._conn.executemany(_EMAIL_INSERT_SQL, [_email_row(r) for r in emails])
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('_migrated_from_json', ?)",
+                                   (json.dumps(datetime.now(timezone.utc).isoformat()),))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if state is not None:
+                os.replace(json_path, json_path + ".migrated")
+                log(f"[state] migrated {json_path} into {self.path}")
+
+    def _write_all(self, state):
+        now = datetime.now(timezone.utc).isoformat()
+        for section in STATE_RECORD_SECTIONS:
+            self._conn.execute(f"DELETE FROM {section}")
+            self._conn.executemany(
+                f"INSERT INTO {section} (user_id, value, updated_at) VALUES (?, ?, ?)",
+                [(str(uid), json.dumps(value, sort_keys=True), now) for uid, value in (state.get(section) or {}).items()])
+        self._conn.execute("DELETE FROM meta WHERE key NOT LIKE '\\_%' ESCAPE '\\'")
+        self._conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                               [(k, json.dumps(v)) for k, v in state.items() if _is_meta_key(k)])
+
+    def _load_mirror(self):
+        """Mirror of what is on disk, as JSON text per row, used to diff saves."""
+        with self._lock:
+            self._mirror = {section: dict(self._conn.execute(f"SELECT user_id, value FROM {section}"))
+                            for section in STATE_RECORD_SECTIONS}
+            self._mirror["meta"] = {k: v for k, v in self._conn.execute("SELECT key, value FROM meta")
+                                    if _is_meta_key(k)}
+
+    def load(self):
+        with self._lock:
+            return _state_from_mirror(self._mirror)
+
+    def save(self, state):
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            changes = _state_changes(self._mirror, state)
+            if changes is None:
+                return
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for section in STATE_RECORD_SECTIONS:
+                    self._conn.executemany(
+                        f"INSERT INTO {section} (user_id, value, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                        [(uid, text, now) for uid, text in changes["upserts"][section]])
+                    self._conn.executemany(f"DELETE FROM {section} WHERE user_id = ?",
+                                           [(uid,) for uid in changes["deletes"][section]])
+                self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", changes["meta"])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            _apply_state_changes(self._mirror, changes)
+
+    def replace(self, state):
+        """Overwrite everything (used by restore)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_all(_normalize_state(state))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._load_mirror()
+
+STATE_JOURNAL_FILE = f"{STATE_DIR}/state.journal.jsonl"
+JOURNAL_COMPACT_BYTES = int(os.environ.get("JOURNAL_COMPACT_BYTES", str(1024 * 1024)))
+JOURNAL_FSYNC_SECS = float(os.environ.get("JOURNAL_FSYNC_SECS", "1.0"))
+
+class JournalStateStore:
+    """
+    Flat-file state without full rewrites: state.json is the last snapshot and
+    every save() appends its changed keys to state.journal.jsonl. Appends are
+    fsynced in groups (at most once per JOURNAL_FSYNC_SECS); the journal is
+    replayed on startup and compacted into a new snapshot once it grows past
+    JOURNAL_COMPACT_BYTES.
+    """
+
+    def __init__(self, snapshot_path=STATE_FILE, journal_path=STATE_JOURNAL_FILE):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self._lock = threading.RLock()
+        self._journal = None
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+        self._fsync_timer = None
+        state = JsonStateStore(snapshot_path).load()
+        replayed = self._replay(state)
+        self._reset(state)
+        if replayed:
+            log(f"[state] replayed {replayed} journal records")
+            # Fold this run's predecessors into the snapshot so state.json stays readable on its own
+            self.compact()
+        else:
+            self._open_journal()
+
+    def _replay(self, state):
+        if not os.path.exists(self.journal_path):
+            return 0
+        count, emails = 0, []
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append
+                    log("[state] ignoring unreadable journal line")
+                    continue
+                op = rec.get("op")
+                if op == "set":
+                    state.setdefault(rec["section"], {})[rec["key"]] = rec["value"]
+                elif op == "del":
+                    state.setdefault(rec["section"], {}).pop(rec["key"], None)
+                elif op == "meta":
+                    state[rec["key"]] = rec["value"]
+                elif op == "email":
+                    # Written by versions that kept the email log in the state
+                    emails.append(rec["record"])
+                count += 1
+        _import_legacy_emails(emails)
+        return count
+
+    def _reset(self, state):
+        self._mirror = _state_mirror(state)
+
+    def _open_journal(self):
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def load(self):
+        with self._lock:
+            return _state_from_mirror(self._mirror)
+
+    @staticmethod
+    def _records(changes):
+        # Values are already JSON text in the diff; splice them in rather than re-encoding
+        for section in STATE_RECORD_SECTIONS:
+            for uid, text in changes["upserts"][section]:
+                yield f'{{"op":"set","section":"{section}","key":{json.dumps(uid)},"value":{text}}}\n'
+            for uid in changes["deletes"][section]:
+                yield f'{{"op":"del","section":"{section}","key":{json.dumps(uid)}}}\n'
+        for key, text in changes["meta"]:
+            yield f'{{"op":"meta","key":{json.dumps(key)},"value":{text}}}\n'
+
+    def save(self, state):
+        with self._lock:
+            changes = _state_changes(self._mirror, state)
+            if changes is None:
+                return
+            self._journal.write("".join(self._records(changes)))
+            self._journal.flush()
+            _apply_state_changes(self._mirror, changes)
+            self._dirty = True
+            if time.monotonic() - self._last_fsync >= JOURNAL_FSYNC_SECS:
+                self._fsync()
+            elif self._fsync_timer is None:
+                # Group commit: whatever else arrives before the timer fires shares one fsync
+                self._fsync_timer = threading.Timer(JOURNAL_FSYNC_SECS, self.sync)
+                self._fsync_timer.daemon = True
+                self._fsync_timer.start()
+            if self._journal.tell() >= JOURNAL_COMPACT_BYTES:
+                self.compact()
+
+    def _fsync(self):
+        if self._dirty and self._journal is not None:
+            os.fsync(self._journal.fileno())
+            self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def sync(self):
+        """Flush pending journal appends to disk."""
+        with self._lock:
+            self._fsync_timer = None
+            self._fsync()
+
+    def _write_snapshot(self, state):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def compact(self):
+        """Write the current state as a new snapshot and start an empty journal."""
+        with self._lock:
+            self._write_snapshot(_state_from_mirror(self._mirror))
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+            os.fsync(self._journal.fileno())
+            self._dirty = False
+            log("[state] journal compacted into snapshot")
+
+    def replace(self, state):
+        with self._lock:
+            state = _normalize_state(state)
+            self._reset(state)
+            self.compact()
+
+_state_store = None
+_state_store_lock = threading.RLock()
+
+def get_state_store():
+    """The process-wide state store selected by STATE_BACKEND."""
+    global _state_store
+    if _state_store is None:
+        with _state_store_lock:
+            if _state_store is None:
+                if STATE_BACKEND == "sqlite":
+                    _state_store = SqliteStateStore()
+                elif STATE_BACKEND == "journal":
+                    _state_store = JournalStateStore()
+                else:
+                    _state_store = JsonStateStore()
+    return _state_store
+
+# ---- State manager ----
+STATE_FLUSH_DELAY_SECS = float(os.environ.get("STATE_FLUSH_DELAY_SECS", "1.0"))
+
+class StateManager:
+    """
+    Single in-process owner of the live state. Reads are served from memory;
+    writes go through the mutation methods below, which mark the state dirty and
+    schedule one debounced flush to the store, so a burst of changes (and every
+    thread's changes) lands in a single atomic save instead of racing saves.
+    Values are replaced, never mutated in place, so flushes can copy shallowly.
+    """
+
+    def __init__(self, store, flush_delay=STATE_FLUSH_DELAY_SECS):
+        self._store = store
+        self._flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._state = store.load()
+        self._dirty = False
+        self._timer = None
+        self._revisions = {}
+
+    def _copy(self):
+        return {k: (dict(v) if isinstance(v, dict) else list(v) if isinstance(v, list) else v)
+                for k, v in self._state.items()}
+
+    def _mark_dirty(self, *keys):
+        # No keys means "could be anything" (transactions, wholesale replacement)
+        for key in keys or list(self._state) + ["*"]:
+            self._revisions[key] = self._revisions.get(key, 0) + 1
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    # ---- reads ----
+    def read(self):
+        """Copy of the whole state."""
+        with self._lock:
+            return self._copy()
+
+    def section(self, name):
+        """Copy of one record section, e.g. "welcomed"."""
+        with self._lock:
+            return dict(self._state.get(name) or {})
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._state.get(key, default)
+
+    def revision(self, *keys):
+        """Change counter for the given top-level keys; equal revisions mean no writes in between."""
+        with self._lock:
+            return tuple(self._revisions.get(key, 0) + self._revisions.get("*", 0) for key in keys)
+
+    # ---- writes ----
+    def set_record(self, section, user_id, value):
+        with self._lock:
+            self._state.setdefault(section, {})[str(user_id)] = value
+            self._mark_dirty(section)
+
+    def pop_record(self, section, user_id):
+        with self._lock:
+            records = self._state.setdefault(section, {})
+            if str(user_id) not in records:
+                return None
+            value = records.pop(str(user_id))
+            self._mark_dirty(section)
+            return value
+
+    def set_value(self, key, value):
+        with self._lock:
+            self._state[key] = value
+            self._mark_dirty(key)
+
+    @contextmanager
+    def transaction(self):
+        """Hold the lock across several changes: `with state_manager().transaction() as state: ...`"""
+        with self._lock:
+            yield self._state
+            self._mark_dirty()
+
+    def update_from(self, state):
+        """Replace the live state with a caller's full copy (load_state/save_state compatibility)."""
+        with self._lock:
+            self._state = _normalize_state({k: v for k, v in state.items()})
+            self._mark_dirty()
+
+    def replace(self, state):
+        """Replace the state in memory and in the store immediately (restore)."""
+        with self._flush_lock, self._lock:
+            self._store.replace(state)
+            self._state = self._store.load()
+            self._dirty = False
+            self._revisions["*"] = self._revisions.get("*", 0) + 1
+
+    def flush(self):
+        """Write pending changes to the store now."""
+        with self._flush_lock:
+            with self._lock:
+                self._timer = None
+                if not self._dirty:
+                    return
+                snapshot = self._copy()
+                self._dirty = False
+            try:
+                self._store.save(snapshot)
+            except Exception as e:
+                log(f"[state] flush failed, will retry: {e}")
+                with self._lock:
+                    self._mark_dirty("_flush_retry")
+
+_state_manager = None
+
+def state_manager():
+    """The process-wide StateManager over get_state_store()."""
+    global _state_manager
+    if _state_manager is None:
+        with _state_store_lock:
+            if _state_manager is None:
+                _state_manager = StateManager(get_state_store())
+                atexit.register(_state_manager.flush)
+    return _state_manager
 
 def load_state():
-    if not os.path.exists(STATE_FILE):
-        return {
-            "welcomed": {}, 
-            "warned": {}, 
-            "removed": {}, 
-            "last_inactivity_scan": None,
-            "email_history": [],  # Track all emails sent
-            "first_run_complete": False  # Flag for first-run setup
-        }
-    with open(STATE_FILE,"r") as f:
-        state = json.load(f)
-        # Ensure new fields exist for backwards compatibility
-        if "email_history" not in state:
-            state["email_history"] = []
-        if "first_run_complete" not in state:
-            state["first_run_complete"] = False
-        return state
+    """Copy of the live state (served from memory)."""
+    return state_manager().read()
 
 def save_state(state):
-    tmp = STATE_FILE + ".tmp"
-    with open(tmp,"w") as f:
-        json.dump(state, f, indent=2, sort_keys=True)
-    os.replace(tmp, STATE_FILE)
-
-@retry_on_failure(max_retries=3, delay=3, exceptions=(smtplib.SMTPException, OSError))
-def send_email(to_addr, subject, html_body):
-    """Send email with retry logic and error handling"""
+    """Compatibility for load/modify/save callers; prefer the StateManager mutation methods."""
+    state_manager().update_from(state)
+
+def replace_state(state):
+    """Replace the whole state, e.g. from a backup."""
+    state = dict(state)
+    _import_legacy_emails(state.pop("email_history", None))
+    state_manager().replace(state)
+
+# ==================== EMAIL HISTORY ====================
+# The email log is append-only and kept apart from the state document, so logging
+# an email or paging the history never loads or rewrites the user records. With
+# STATE_BACKEND=sqlite it is the email_history table of state.db; otherwise it is
+# a directory of rotating JSONL segments.
+
+EMAIL_HISTORY_DIR = f"{STATE_DIR}/email_history"
+EMAIL_HISTORY_SEGMENT_BYTES = int(os.environ.get("EMAIL_HISTORY_SEGMENT_BYTES", str(256 * 1024)))
+EMAIL_HISTORY_MAX_RECORDS = int(os.environ.get("EMAIL_HISTORY_MAX_RECORDS", "5000"))  # 0 = unlimited
+EMAIL_HISTORY_RETENTION_DAYS = int(os.environ.get("EMAIL_HISTORY_RETENTION_DAYS", "0"))  # 0 = keep by count only
+EMAIL_HISTORY_PRUNE_EVERY = 100
+
+_EMAIL_INSERT_SQL = ("INSERT INTO email_history (timestamp, recipient, subject, status, error) "
+                     "VALUES (?, ?, ?, ?, ?)")
+
+def _email_row(record):
+    return (record.get("timestamp"), record.get("to"), record.get("subject"),
+            record.get("status"), record.get("error"))
+
+def _email_history_cutoff():
+    if EMAIL_HISTORY_RETENTION_DAYS <= 0:
+        return None
+    return (datetime.now(timezone.utc) - timedelta(days=EMAIL_HISTORY_RETENTION_DAYS)).isoformat()
+
+def _history_bound(value, end=False):
+    """
+    Normalize a date or datetime query bound to the UTC ISO form the log stores,
+    so bounds compare as strings. A date-only `until` covers that whole day.
+    """
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if end and len(value) == 10:
+        dt += timedelta(days=1)
+    return dt.astimezone(timezone.utc).isoformat()
+
+def _email_matches(record, status, recipient, since, until):
+    if status and record.get("status") != status:
+        return False
+    if recipient and (record.get("to") or "").lower() != recipient:
+        return False
+    ts = record.get("timestamp") or ""
+    if since and ts < since:
+        return False
+    if until and ts >= until:
+        return False
+    return True
+
+class JsonlEmailHistory:
+    """
+    Email log as rotating JSONL segments (emails-000001.jsonl, ...). Each record
+    gets an increasing "id" that serves as the pagination cursor. Queries walk
+    segments newest-first and skip whole segments outside the cursor or date
+    range. Retention drops whole segments, oldest first, never the active one.
+    """
+
+    def __init__(self, directory=EMAIL_HISTORY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._segments = []  # oldest first; per-segment id/timestamp bounds and record count
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("emails-") and name.endswith(".jsonl"):
+                segment = self._scan(os.path.join(directory, name))
+                if segment["count"]:
+                    self._segments.append(segment)
+                else:
+                    os.remove(segment["path"])
+        self._next_id = self._segments[-1]["last_id"] + 1 if self._segments else 1
+        self._prune()
+
+    @staticmethod
+    def _new_segment(path):
+        return {"path": path, "seq": int(os.path.basename(path)[7:-6]), "count": 0,
+                "first_id": None, "last_id": None, "first_ts": None, "last_ts": None}
+
+    @staticmethod
+    def _note(segment, record):
+        ts = record.get("timestamp") or ""
+        if segment["count"] == 0:
+            segment["first_id"], segment["first_ts"], segment["last_ts"] = record["id"], ts, ts
+        segment["last_id"] = record["id"]
+        segment["first_ts"] = min(segment["first_ts"], ts)
+        segment["last_ts"] = max(segment["last_ts"], ts)
+        segment["count"] += 1
+
+    def _scan(self, path):
+        segment = self._new_segment(path)
+        for record in self._read(path):
+            self._note(segment, record)
+        return segment
+
+    @staticmethod
+    def _read(path):
+        records = []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A torn line from a crash mid-append
+                        continue
+        except FileNotFoundError:
+            # Pruned while a reader was walking the segment list
+            pass
+        return records
+
+    def _writer(self):
+        if self._file is None:
+            if not self._segments or os.path.getsize(self._segments[-1]["path"]) >= EMAIL_HISTORY_SEGMENT_BYTES:
+                seq = self._segments[-1]["seq"] + 1 if self._segments else 1
+                self._segments.append(self._new_segment(os.path.join(self.directory, f"emails-{seq:06d}.jsonl")))
+            self._file = open(self._segments[-1]["path"], "a", encoding="utf-8")
+        return self._file
+
+    def _prune(self):
+        cutoff = _email_history_cutoff()
+        total = sum(s["count"] for s in self._segments)
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_old = cutoff is not None and oldest["last_ts"] < cutoff
+            too_many = EMAIL_HISTORY_MAX_RECORDS > 0 and total - oldest["count"] >= EMAIL_HISTORY_MAX_RECORDS
+            if not (too_old or too_many):
+                break
+            os.remove(oldest["path"])
+            self._segments.pop(0)
+            total -= oldest["count"]
+
+    def append(self, record):
+        with self._lock:
+            record = dict(record, id=self._next_id)
+            self._next_id += 1
+            f = self._writer()
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            self._note(self._segments[-1], record)
+            if f.tell() >= EMAIL_HISTORY_SEGMENT_BYTES:
+                f.close()
+                self._file = None
+                self._prune()
+            return record
+
+    def query(self, cursor=None, limit=100, status=None, recipient=None, since=None, until=None):
+        """Newest-first page of records with id < cursor; returns (records, next_cursor)."""
+        since, until = _history_bound(since), _history_bound(until, end=True)
+        recipient = recipient.lower() if recipient else None
+        with self._lock:
+            segments = [dict(s) for s in self._segments]
+        page = []
+        for segment in reversed(segments):
+            if not segment["count"] or (cursor is not None and segment["first_id"] >= cursor):
+                continue
+            if since and segment["last_ts"] < since:
+                break
+            if until and segment["first_ts"] >= until:
+                continue
+            for record in reversed(self._read(segment["path"])):
+                if cursor is not None and record["id"] >= cursor:
+                    continue
+                if _email_matches(record, status, recipient, since, until):
+                    page.append(record)
+                    if len(page) >= limit:
+                        return page, record["id"]
+        return page, None
+
+    def count(self):
+        with self._lock:
+            return sum(s["count"] for s in self._segments)
+
+    def latest_timestamp(self):
+        with self._lock:
+            return max((s["last_ts"] for s in self._segments if s["count"]), default=None)
+
+    def last_id(self):
+        with self._lock:
+            return self._next_id - 1
+
+    def iter_records(self, after_id=None):
+        """Records with id > after_id, oldest first (for backups)."""
+        with self._lock:
+            paths = [s["path"] for s in self._segments if after_id is None or s["last_id"] > after_id]
+        for path in paths:
+            for record in self._read(path):
+                if after_id is None or record["id"] > after_id:
+                    yield record
+
+    def import_records(self, records):
+        """Append records newer than the newest stored one; safe to repeat with the same input."""
+        newest = self.latest_timestamp()
+        imported = 0
+        for record in records:
+            if newest is None or (record.get("timestamp") or "") > newest:
+                self.append({k: v for k, v in record.items() if k != "id"})
+                imported += 1
+        return imported
+
+class SqliteEmailHistory:
+    """Email log in the email_history table of the SQLite state database; the row id is the cursor."""
+
+    def __init__(self, store):
+        self._conn = store._conn
+        self._lock = store._lock
+        self._appends = 0
+        self._prune()
+
+    @staticmethod
+    def _record(row):
+        rid, ts, to, subject, status, error = row
+        return {"id": rid, "timestamp": ts, "to": to, "subject": subject, "status": status, "error": error}
+
+    def _prune(self):
+        with self._lock:
+            cutoff = _email_history_cutoff()
+            if cutoff is not None:
+                self._conn.execute("DELETE FROM email_history WHERE timestamp < ?", (cutoff,))
+            if EMAIL_HISTORY_MAX_RECORDS > 0:
+                self._conn.execute("DELETE FROM email_history WHERE id <= "
+                                   "(SELECT id FROM email_history ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                                   (EMAIL_HISTORY_MAX_RECORDS,))
+
+    def append(self, record):
+        with self._lock:
+            cur = self._conn.execute(_EMAIL_INSERT_SQL, _email_row(record))
+            self._appends += 1
+            if self._appends % EMAIL_HISTORY_PRUNE_EVERY == 0:
+                self._prune()
+            return dict(record, id=cur.lastrowid)
+
+    def query(self, cursor=None, limit=100, status=None, recipient=None, since=None, until=None):
+        """Newest-first page of records with id < cursor; returns (records, next_cursor)."""
+        clauses, params = [], []
+        for clause, value in (("id < ?", cursor), ("status = ?", status),
+                              ("recipient = ? COLLATE NOCASE", recipient),
+                              ("timestamp >= ?", _history_bound(since)),
+                              ("timestamp < ?", _history_bound(until, end=True))):
+            if value is not None and value != "":
+                clauses.append(clause)
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, timestamp, recipient, subject, status, error FROM email_history {where}"
+                "ORDER BY id DESC LIMIT ?", params + [limit]).fetchall()
+        page = [self._record(row) for row in rows]
+        return page, (page[-1]["id"] if len(page) >= limit else None)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM email_history").fetchone()[0]
+
+    def latest_timestamp(self):
+        with self._lock:
+            return self._conn.execute("SELECT MAX(timestamp) FROM email_history").fetchone()[0]
+
+    def last_id(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM email_history").fetchone()[0]
+
+    def iter_records(self, after_id=None):
+        """Records with id > after_id, oldest first, read a page at a time (for backups)."""
+        last = after_id or 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, timestamp, recipient, subject, status, error FROM email_history "
+                    "WHERE id > ? ORDER BY id LIMIT 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._record(row)
+            last = rows[-1][0]
+
+    def import_records(self, records):
+        """Append records newer than the newest stored one; safe to repeat with the same input."""
+        newest = self.latest_timestamp()
+        imported, batch = 0, []
+        for record in records:
+            if newest is None or (record.get("timestamp") or "") > newest:
+                batch.append(_email_row(record))
+            if len(batch) >= 500:
+                with self._lock:
+                    self._conn.executemany(_EMAIL_INSERT_SQL, batch)
+                imported, batch = imported + len(batch), []
+        with self._lock:
+            self._conn.executemany(_EMAIL_INSERT_SQL, batch)
+        return imported + len(batch)
+
+_email_history = None
+
+def email_history_store():
+    """The process-wide email log for the active STATE_BACKEND."""
+    global _email_history
+    if _email_history is None:
+        with _state_store_lock:
+            if _email_history is None:
+                if STATE_BACKEND == "sqlite":
+                    _email_history = SqliteEmailHistory(get_state_store())
+                else:
+                    _email_history = JsonlEmailHistory()
+    return _email_history
+
+def _import_legacy_emails(records):
+    """Move an email log found inside a state document (older versions, old backups) into the log."""
+    if records:
+        imported = email_history_store().import_records(records)
+        if imported:
+            log(f"[state] moved {imported} email history records into the email log")
+
+# ==================== STATE ARCHIVE ====================
+# Users who left Plex (removed or departed) more than ARCHIVE_AFTER_DAYS ago are
+# moved out of the live state into gzip archives, one per month of departure, so
+# the hot state only holds users who are, or recently were, on the server.
+
+ARCHIVE_DIR = f"{STATE_DIR}/archive"
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))  # 0 disables archiving
+
+class StateArchive:
+    """
+    Cold tier of the state. All of a user's records (welcomed, warned, removed,
+    departed) move together into archive/YYYY-MM.json.gz as {user_id: {section:
+    value}}. index.json maps archived ids to their month and sections, so
+    membership checks and counts never open a month file; month files are read
+    only when history is requested or an archived user rejoins.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Re-read index.json (e.g. after a restore replaced the archive files)."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._index_path = os.path.join(self.directory, "index.json")
+        with self._lock:
+            self._index = {}
+            if os.path.exists(self._index_path):
+                with open(self._index_path, "r") as f:
+                    self._index = json.load(f)
+
+    def _month_path(self, month):
+        return os.path.join(self.directory, f"{month}.json.gz")
+
+    def _read_month(self, month):
+        try:
+            with gzip.open(self._month_path(month), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_month(self, month, users):
+        path = self._month_path(month)
+        if not users:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(users, f, sort_keys=True)
+        os.replace(tmp, path)
+
+    def _write_index(self):
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._index, f, sort_keys=True)
+        os.replace(tmp, self._index_path)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._index
+
+    def archive(self, entries):
+        """Store {user_id: (month, {section: value})}; month files are written before the index."""
+        by_month = {}
+        for uid, (month, records) in entries.items():
+            by_month.setdefault(month, {})[str(uid)] = records
+        with self._lock:
+            for month, users in by_month.items():
+                stored = self._read_month(month)
+                stored.update(users)
+                self._write_month(month, stored)
+                for uid, records in users.items():
+                    self._index[uid] = {"month": month, "sections": sorted(records)}
+            self._write_index()
+
+    def lookup(self, user_id):
+        """Archived {section: value} for one user, or None."""
+        entry = self._index.get(str(user_id))
+        if entry is None:
+            return None
+        with self._lock:
+            return self._read_month(entry["month"]).get(str(user_id))
+
+    def discard(self, user_ids):
+        """Drop users from the archive (after their records went back into the live state)."""
+        with self._lock:
+            by_month = {}
+            for uid in map(str, user_ids):
+                entry = self._index.pop(uid, None)
+                if entry:
+                    by_month.setdefault(entry["month"], []).append(uid)
+            for month, uids in by_month.items():
+                stored = self._read_month(month)
+                for uid in uids:
+                    stored.pop(uid, None)
+                self._write_month(month, stored)
+            if by_month:
+                self._write_index()
+
+    def months(self):
+        """[{"month", "users"}] newest first, from the index alone."""
+        counts = {}
+        for entry in list(self._index.values()):
+            counts[entry["month"]] = counts.get(entry["month"], 0) + 1
+        return [{"month": m, "users": n} for m, n in sorted(counts.items(), reverse=True)]
+
+    def load_month(self, month):
+        with self._lock:
+            return self._read_month(month)
+
+    def count(self, section=None):
+        entries = list(self._index.values())
+        if section is None:
+            return len(entries)
+        return sum(1 for entry in entries if section in entry["sections"])
+
+    def files(self):
+        """Paths of every archive file, index last (for backups)."""
+        with self._lock:
+            months = sorted({entry["month"] for entry in self._index.values()})
+        return [p for p in map(self._month_path, months) if os.path.exists(p)] + \
+               ([self._index_path] if os.path.exists(self._index_path) else [])
+
+_state_archive = None
+
+def state_archive():
+    global _state_archive
+    if _state_archive is None:
+        with _state_store_lock:
+            if _state_archive is None:
+                _state_archive = StateArchive()
+    return _state_archive
+
+def _left_at(state, uid):
+    """When a user left Plex, from their removed/departed records (latest wins)."""
+    left = None
+    for section in ("removed", "departed"):
+        record = state[section].get(uid)
+        when = record.get("when") if isinstance(record, dict) else record
+        try:
+            when = datetime.fromisoformat(when)
+        except (TypeError, ValueError):
+            continue
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        left = when if left is None else max(left, when)
+    return left
+
+def archive_cold_records(plex_ids):
+    """
+    Move users who are not on Plex and left more than ARCHIVE_AFTER_DAYS ago into
+    the archive. plex_ids must come from a current Plex listing. Returns the count.
+    """
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    manager = state_manager()
+    state = manager.read()
+    entries = {}
+    for uid in set(state["removed"]) | set(state["departed"]):
+        if uid in plex_ids:
+            continue
+        left = _left_at(state, uid)
+        if left is None or left > cutoff:
+            continue
+        records = {section: state[section][uid] for section in STATE_RECORD_SECTIONS if uid in state[section]}
+        entries[uid] = (left.strftime("%Y-%m"), records)
+    if not entries:
+        return 0
+    # Archive first: a crash before the state flush leaves a duplicate, never a loss
+    state_archive().archive(entries)
+    with manager.transaction() as live:
+        for uid, (_, records) in entries.items():
+            for section, value in records.items():
+                # Leave anything that changed since the read above in the live state
+                if live[section].get(uid) == value:
+                    live[section].pop(uid)
+    log(f"[archive] moved {len(entries)} user(s) who left over {ARCHIVE_AFTER_DAYS} days ago into the archive")
+    return len(entries)
+
+def restore_archived_users(user_ids):
+    """Put archived users (e.g. someone rejoining Plex) back into the live state. Returns their ids."""
+    archive = state_archive()
+    ids = [str(uid) for uid in user_ids if uid in archive]
+    if not ids:
+        return []
+    manager = state_manager()
+    with manager.transaction() as live:
+        for uid in ids:
+            for section, value in (archive.lookup(uid) or {}).items():
+                live[section].setdefault(uid, value)
+    manager.flush()
+    archive.discard(ids)
+    log(f"[archive] restored {len(ids)} archived user(s) to the live state")
+    return ids
+
+# ==================== BACKUPS ====================
+# Backups are produced as a ZIP stream with bounded memory. Every completed backup
+# leaves a catalog (per-record hashes, the email log high-water mark and archive
+# file stamps) under /app/state/backups, so a later backup taken against its id
+# carries only what changed since. Restores read entries straight from the upload
+# and validate all of them before anything is applied.
+
+import io, re, shutil, zipfile, zlib
+
+BACKUP_CATALOG_DIR = f"{STATE_DIR}/backups"
+BACKUP_CATALOG_KEEP = int(os.environ.get("BACKUP_CATALOG_KEEP", "20"))
+BACKUP_MAX_ENTRY_BYTES = int(os.environ.get("BACKUP_MAX_ENTRY_BYTES", str(512 * 1024 * 1024)))
+BACKUP_CHUNK_BYTES = 64 * 1024
+_BACKUP_ID_RE = re.compile(r"^\d{8}T\d{6}Z-[0-9a-f]{6}$")
+_BACKUP_ENTRY_RE = re.compile(r"^(manifest\.json|config\.env|state\.json|state\.delta\.json|email_history\.jsonl"
+                              r"|archive/(index\.json|\d{4}-\d{2}\.json\.gz))$")
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable ZipFile target; the backup generator drains it as chunks accumulate."""
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._size += len(b)
+        return len(b)
+
+    def pending(self):
+        return self._size
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks, self._size = [], 0
+        return data
+
+def _record_hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def _file_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(BACKUP_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+def _coalesce(pieces):
+    """Group many small str/bytes pieces into BACKUP_CHUNK_BYTES-sized bytes."""
+    buf, size = [], 0
+    for piece in pieces:
+        piece = piece.encode("utf-8") if isinstance(piece, str) else piece
+        buf.append(piece)
+        size += len(piece)
+        if size >= BACKUP_CHUNK_BYTES:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
+
+def load_backup_catalog(backup_id):
+    if not _BACKUP_ID_RE.match(backup_id or ""):
+        raise ValueError(f"Invalid backup id: {backup_id}")
+    path = os.path.join(BACKUP_CATALOG_DIR, f"{backup_id}.json")
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown backup id: {backup_id} (catalogs are kept for the last {BACKUP_CATALOG_KEEP} backups)")
+    with open(path, "r") as f:
+        return json.load(f)
+
+def backup_catalogs():
+    """[{"backup_id", "created", "type", "base"}] newest first."""
+    if not os.path.isdir(BACKUP_CATALOG_DIR):
+        return []
+    catalogs = []
+    for name in sorted(os.listdir(BACKUP_CATALOG_DIR), reverse=True):
+        if name.endswith(".json") and _BACKUP_ID_RE.match(name[:-5]):
+            catalog = load_backup_catalog(name[:-5])
+            catalogs.append({k: catalog.get(k) for k in ("backup_id", "created", "type", "base")})
+    return catalogs
+
+def _write_backup_catalog(catalog):
+    os.makedirs(BACKUP_CATALOG_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_CATALOG_DIR, f"{catalog['backup_id']}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(catalog, f)
+    os.replace(path + ".tmp", path)
+    # Ids start with their UTC timestamp, so name order is age order
+    names = sorted(n for n in os.listdir(BACKUP_CATALOG_DIR) if n.endswith(".json"))
+    for name in names[:-BACKUP_CATALOG_KEEP] if BACKUP_CATALOG_KEEP > 0 else []:
+        os.remove(os.path.join(BACKUP_CATALOG_DIR, name))
+
+def stream_backup(base_id=None, env_path=None):
+    """
+    Prepare a backup and return (backup_id, chunks), where chunks yields the ZIP
+    bytes. With base_id only changes since that backup are included: a
+    state.delta.json instead of state.json, newer email log records and changed
+    archive files. The catalog is written once the last chunk has been produced,
+    so only complete backups can serve as a base.
+    """
+    base = load_backup_catalog(base_id) if base_id else None
+    now = datetime.now(timezone.utc)
+    backup_id = f"{now.strftime('%Y%m%dT%H%M%SZ')}-{os.urandom(3).hex()}"
+    state = state_manager().read()
+    hashes = {section: {uid: _record_hash(value) for uid, value in (state.get(section) or {}).items()}
+              for section in STATE_RECORD_SECTIONS}
+    history = email_history_store()
+    email_mark = history.last_id()
+    archive = state_archive()
+    stamps = {}
+    for path in archive.files():
+        st = os.stat(path)
+        stamps[os.path.basename(path)] = [st.st_mtime_ns, st.st_size]
+
+    entries = []
+    if env_path and os.path.exists(env_path):
+        entries.append(("config.env", _file_chunks(env_path)))
+    if base is None:
+        entries.append(("state.json", _coalesce(json.JSONEncoder(indent=2, sort_keys=True).iterencode(state))))
+    else:
+        delta = {"base": base_id, "upserts": {}, "deletes": {},
+                 "meta": {k: v for k, v in state.items() if _is_meta_key(k)}}
+        for section in STATE_RECORD_SECTIONS:
+            previous = base["records"].get(section, {})
+            delta["upserts"][section] = {uid: state[section][uid] for uid, h in hashes[section].items()
+                                         if previous.get(uid) != h}
+            delta["deletes"][section] = [uid for uid in previous if uid not in hashes[section]]
+        entries.append(("state.delta.json", [json.dumps(delta, indent=2, sort_keys=True).encode("utf-8")]))
+    emails = history.iter_records(base["email_id"] if base else None)
+    entries.append(("email_history.jsonl",
+                    _coalesce(json.dumps(r) + "\n" for r in emails if r["id"] <= email_mark)))
+    for name, stamp in stamps.items():
+        if base is None or base.get("archive", {}).get(name) != stamp:
+            entries.append((f"archive/{name}", _file_chunks(os.path.join(archive.directory, name))))
+
+    manifest = {
+        "backup_id": backup_id,
+        "backup_date": now.isoformat(),
+        "version": "2.0",
+        "type": "full" if base is None else "incremental",
+        "base": base_id,
+        "files": [name for name, _ in entries],
+    }
+
+    def chunks():
+        sink = _ZipSink()
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("manifest.json", json.dumps(manifest, indent=2))
+            for name, pieces in entries:
+                with zf.open(name, "w", force_zip64=True) as f:
+                    for piece in pieces:
+                        f.write(piece)
+                        if sink.pending() >= BACKUP_CHUNK_BYTES:
+                            yield sink.drain()
+        yield sink.drain()
+        _write_backup_catalog({"backup_id": backup_id, "created": now.isoformat(), "type": manifest["type"],
+                               "base": base_id, "records": hashes, "email_id": email_mark, "archive": stamps})
+        log(f"[backup] {manifest['type']} backup {backup_id} completed")
+
+    return backup_id, chunks()
+
+def _read_backup_entry(zf, info):
+    with zf.open(info) as f:
+        data = f.read(BACKUP_MAX_ENTRY_BYTES + 1)
+    if len(data) > BACKUP_MAX_ENTRY_BYTES:
+        raise ValueError(f"{info.filename} is larger than {BACKUP_MAX_ENTRY_BYTES} bytes")
+    return data
+
+def _iter_backup_emails(zf, info):
+    with zf.open(info) as raw:
+        for n, line in enumerate(io.TextIOWrapper(raw, encoding="utf-8"), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"email_history.jsonl line {n} is not valid JSON")
+            if not isinstance(record, dict) or "timestamp" not in record:
+                raise ValueError(f"email_history.jsonl line {n} is not an email record")
+            yield record
+
+def _validate_backup_state(state, name):
+    if not isinstance(state, dict):
+        raise ValueError(f"{name} is not a JSON object")
+    for section in STATE_RECORD_SECTIONS:
+        if not isinstance(state.get(section, {}), dict):
+            raise ValueError(f"{name}: '{section}' is not an object")
+
+def _validate_backup_delta(delta):
+    if not isinstance(delta, dict):
+        raise ValueError("state.delta.json is not a JSON object")
+    for key, kind in (("upserts", dict), ("deletes", dict), ("meta", dict)):
+        if not isinstance(delta.get(key, {}), kind):
+            raise ValueError(f"state.delta.json: '{key}' is not an object")
+    _validate_backup_state(delta.get("upserts", {}), "state.delta.json upserts")
+    for section, uids in delta.get("deletes", {}).items():
+        if section not in STATE_RECORD_SECTIONS or not isinstance(uids, list):
+            raise ValueError(f"state.delta.json: bad deletes for '{section}'")
+
+def _check_backup_base(base_id):
+    """
+    An incremental backup only makes sense on top of its base: the live records
+    must hash exactly as they did when backup base_id was taken (e.g. right
+    after restoring that backup).
+    """
     try:
-        msg = MIMEText(html_body, "html")
-        msg["Subject"] = subject
-        msg["From"] = os.environ.get("SMTP_FROM", SMTP_FROM)
-        msg["To"] = to_addr
-        
-        smtp_host = os.environ.get("SMTP_HOST", SMTP_HOST)
-        smtp_port = int(os.environ.get("SMTP_PORT", SMTP_PORT))
-        
+        catalog = load_backup_catalog(base_id)
+    except ValueError:
+        raise ValueError(f"incremental backup requires base {base_id}")
+    state = state_manager().read()
+    for section in STATE_RECORD_SECTIONS:
+        live = {uid: _record_hash(value) for uid, value in (state.get(section) or {}).items()}
+        if live != catalog["records"].get(section, {}):
+            raise ValueError(f"incremental backup requires base {base_id}")
+
+def _apply_backup_delta(delta):
+    with state_manager().transaction() as live:
+        for section in STATE_RECORD_SECTIONS:
+            records = live.setdefault(section, {})
+            for uid in delta.get("deletes", {}).get(section, []):
+                records.pop(uid, None)
+            records.update(delta.get("upserts", {}).get(section, {}))
+        for key, value in delta.get("meta", {}).items():
+            if _is_meta_key(key):
+                live[key] = value
+
+def restore_backup(fileobj, env_path=None):
+    """
+    Restore a backup ZIP from a seekable file object (e.g. the upload) without
+    extracting it. Entry names, sizes and contents (JSON structure, every email
+    log line, archive files) are validated first; ValueError means nothing was
+    changed. Full backups replace the state; incremental ones apply their delta
+    and are refused unless the current state is exactly their base backup's.
+    Returns a summary dict.
+    """
+    try:
+        zf = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ValueError("Not a valid ZIP file")
+    with zf:
+        try:
+            infos = {}
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                if not _BACKUP_ENTRY_RE.match(info.filename):
+                    raise ValueError(f"Unexpected entry in backup: {info.filename}")
+                if info.file_size > BACKUP_MAX_ENTRY_BYTES:
+                    raise ValueError(f"{info.filename} is larger than {BACKUP_MAX_ENTRY_BYTES} bytes")
+                infos[info.filename] = info
+            manifest = json.loads(_read_backup_entry(zf, infos["manifest.json"])) if "manifest.json" in infos else {}
+            kind = manifest.get("type", "full")
+            config = state = delta = None
+            if "config.env" in infos:
+                config = _read_backup_entry(zf, infos["config.env"]).decode("utf-8")
+            if "state.json" in infos:
+                state = json.loads(_read_backup_entry(zf, infos["state.json"]))
+                _validate_backup_state(state, "state.json")
+            if "state.delta.json" in infos:
+                delta = json.loads(_read_backup_entry(zf, infos["state.delta.json"]))
+                _validate_backup_delta(delta)
+            if kind == "incremental" and delta is None:
+                raise ValueError("Incremental backup without state.delta.json")
+            if delta is not None:
+                _check_backup_base(delta.get("base") or manifest.get("base"))
+            archives = [info for name, info in infos.items() if name.startswith("archive/")]
+            for info in archives:
+                data = _read_backup_entry(zf, info)
+                json.loads(gzip.decompress(data) if info.filename.endswith(".gz") else data)
+            email_count = 0
+            if "email_history.jsonl" in infos:
+                email_count = sum(1 for _ in _iter_backup_emails(zf, infos["email_history.jsonl"]))
+        except (zipfile.BadZipFile, OSError, EOFError, zlib.error) as e:
+            raise ValueError(f"Corrupt backup: {e}")
+
+        summary = {"type": kind, "backup_id": manifest.get("backup_id"), "config": False,
+                   "state": None, "archive_files": len(archives), "emails": 0}
+        if config is not None and env_path:
+            with open(env_path + ".tmp", "w") as f:
+                f.write(config)
+            os.replace(env_path + ".tmp", env_path)
+            summary["config"] = True
+        if state is not None:
+            replace_state(state)
+            summary["state"] = "replaced"
+        elif delta is not None:
+            _apply_backup_delta(delta)
+            summary["state"] = "delta"
+        if archives:
+            archive = state_archive()
+            for info in archives:
+                target = os.path.join(archive.directory, os.path.basename(info.filename))
+                with zf.open(info) as src, open(target + ".tmp", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(target + ".tmp", target)
+            archive.reload()
+        if email_count:
+            summary["emails"] = email_history_store().import_records(
+                _iter_backup_emails(zf, infos["email_history.jsonl"]))
+    log(f"[backup] restored {summary['type']} backup {summary['backup_id'] or '(unversioned)'}")
+    return summary
+
+# ==================== SMTP POOL ====================
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "2"))
+SMTP_IDLE_SECS = float(os.environ.get("SMTP_IDLE_SECS", "60"))
+
+class SmtpPool:
+    """
+    Authenticated SMTP sessions kept open for reuse, so a tick's worth of mail
+    goes over one or a few sessions instead of a STARTTLS + login per message.
+    At most `size` sessions exist at once; a session idle for longer than
+    `idle_secs` is closed instead of reused, and one the server dropped is
+    replaced and the message sent again once. Settings are read per send, so a
+    config change retires the old sessions.
+    """
+
+    def __init__(self, size=SMTP_POOL_SIZE, idle_secs=SMTP_IDLE_SECS):
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._idle_secs = idle_secs
+        self._lock = threading.Lock()
+        self._idle = []  # [(settings, conn, last_used)]
+        self.stats = {"sent": 0, "connects": 0, "reconnects": 0}
+
+    @staticmethod
+    def _settings():
+        return (os.environ.get("SMTP_HOST", SMTP_HOST), int(os.environ.get("SMTP_PORT", SMTP_PORT)),
+                os.environ.get("SMTP_USERNAME", SMTP_USERNAME), os.environ.get("SMTP_PASSWORD", SMTP_PASSWORD))
+
+    def _connect(self, settings):
+        host, port, username, password = settings
         # Add timeout to SMTP connection
-        with smtplib.SMTP(smtp_host, smtp_port, timeout=15) as s:
-            s.starttls()
-            s.login(os.environ.get("SMTP_USERNAME", SMTP_USERNAME), os.environ.get("SMTP_PASSWORD", SMTP_PASSWORD))
-            s.sendmail(os.environ.get("SMTP_FROM", SMTP_FROM), [to_addr], msg.as_string())
-        
-        # Log successful email send
-        log_email_sent(to_addr, subject, "success")
-        log(f"[SUCCESS] Email sent: {subject} → {to_addr}")
-    except smtplib.SMTPAuthenticationError as e:
-        # Authentication errors won't be fixed by retrying
-        error_msg = f"SMTP authentication failed: {str(e)}"
-        log_email_sent(to_addr, subject, "failed", error_msg)
-        log(f"[ERROR] {error_msg}")
-        raise
-    except smtplib.SMTPException as e:
-        # Other SMTP errors might be temporary
-        error_msg = f"SMTP error: {str(e)}"
-        log_email_sent(to_addr, subject, "failed", error_msg)
-        log(f"[ERROR] Email send failed: {subject} → {to_addr}: {error_msg}")
-        raise
+        conn = smtplib.SMTP(host, port, timeout=15)
+        try:
+            conn.starttls()
+            conn.login(username, password)
+        except Exception:
+            self._close(conn)
+            raise
+        with self._lock:
+            self.stats["connects"] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _checkout(self, settings):
+        now = time.monotonic()
+        stale, conn = [], None
+        with self._lock:
+            while self._idle:
+                idle_settings, idle_conn, last_used = self._idle.pop()
+                if idle_settings == settings and now - last_used < self._idle_secs:
+                    conn = idle_conn
+                    break
+                stale.append(idle_conn)
+        for old in stale:
+            self._close(old)
+        return conn or self._connect(settings)
+
+    def _checkin(self, settings, conn):
+        with self._lock:
+            self._idle.append((settings, conn, time.monotonic()))
+
+    def send(self, from_addr, to_addrs, message):
+        settings = self._settings()
+        with self._slots:
+            conn = self._checkout(settings)
+            try:
+                try:
+                    conn.sendmail(from_addr, to_addrs, message)
+                except smtplib.SMTPServerDisconnected:
+                    # The server timed out or dropped the reused session
+                    self._close(conn)
+                    conn = None
+                    with self._lock:
+                        self.stats["reconnects"] += 1
+                    # _connect() closes its own session if login fails
+                    conn = self._connect(settings)
+                    conn.sendmail(from_addr, to_addrs, message)
+            except smtplib.SMTPResponseException as e:
+                # 421 means the server is closing the session; other replies leave it usable.
+                # conn is None when the error came from reconnecting, with nothing to return
+                if conn is not None:
+                    if e.smtp_code == 421:
+                        self._close(conn)
+                    else:
+                        self._checkin(settings, conn)
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                if conn is not None:
+                    self._checkin(settings, conn)
+                raise
+            except Exception:
+                # Disconnects and socket errors: the session is unusable
+                if conn is not None:
+                    self._close(conn)
+                raise
+            self._checkin(settings, conn)
+            with self._lock:
+                self.stats["sent"] += 1
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, conn, _ in idle:
+            self._close(conn)
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats, idle=len(self._idle))
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+
+def smtp_pool():
+    global _smtp_pool
+    if _smtp_pool is None:
+        with _smtp_pool_lock:
+            if _smtp_pool is None:
+                _smtp_pool = SmtpPool()
+                atexit.register(_smtp_pool.close_all)
+    return _smtp_pool
+
+def _smtp_send(to_addr, subject, html_body):
+    msg = MIMEText(html_body, "html")
+    msg["Subject"] = subject
+    msg["From"] = os.environ.get("SMTP_FROM", SMTP_FROM)
+    msg["To"] = to_addr
+    
+    # Reuses a pooled, already-authenticated session when one is available
+    smtp_pool().send(os.environ.get("SMTP_FROM", SMTP_FROM), [to_addr], msg.as_string())
+
+def _email_error_text(e):
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return f"SMTP authentication failed: {str(e)}"
+    if isinstance(e, smtplib.SMTPException):
+        return f"SMTP error: {str(e)}"
+    return f"Unexpected error: {str(e)}"
+
+def deliver_email(to_addr, subject, html_body):
+    """Send one email right now, without queueing or retries (e.g. the settings test). Raises on failure."""
+    try:
+        _smtp_send(to_addr, subject, html_body)
     except Exception as e:
-        # Log unexpected errors
-        error_msg = f"Unexpected error: {str(e)}"
+        error_msg = _email_error_text(e)
         log_email_sent(to_addr, subject, "failed", error_msg)
         log(f"[ERROR] Email send failed: {subject} → {to_addr}: {error_msg}")
         raise
+    # Log successful email send
+    log_email_sent(to_addr, subject, "success")
+    log(f"[SUCCESS] Email sent: {subject} → {to_addr}")
+
+# ---- SMTP rate limiting ----
+# Per-host token buckets: rate in messages per minute and burst size, matched
+# by host suffix. SMTP_RATE_PER_MIN / SMTP_BURST override the provider default.
+SMTP_PROVIDER_LIMITS = {
+    "gmail.com": (20, 10),
+    "googlemail.com": (20, 10),
+    "office365.com": (30, 10),
+    "outlook.com": (30, 10),
+    "mail.yahoo.com": (10, 5),
+    "zoho.com": (20, 10),
+    "icloud.com": (10, 5),
+    "sendgrid.net": (600, 100),
+    "mailgun.org": (300, 50),
+    "amazonaws.com": (600, 14),
+    "postmarkapp.com": (300, 50),
+}
+SMTP_DEFAULT_LIMIT = (60, 20)
+SMTP_THROTTLE_PAUSE_SECS = float(os.environ.get("SMTP_THROTTLE_PAUSE_SECS", "60"))
+SMTP_THROTTLE_MAX_SECS = float(os.environ.get("SMTP_THROTTLE_MAX_SECS", "900"))
+
+class SmtpRateLimiter:
+    """
+    One TokenBucket per SMTP host, shared by every mail worker. When the relay
+    answers 421/451 the host is paused for everyone, starting at
+    SMTP_THROTTLE_PAUSE_SECS and doubling on each further throttle up to
+    SMTP_THROTTLE_MAX_SECS. The pause runs out on its own; the first send that
+    started after it began and succeeded resets the backoff. Sends already on
+    the wire when the 421 arrived don't count.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._paused_until = {}
+        self._paused_at = {}
+        self._strikes = {}
+        self.stats = {"throttled": 0, "deferred": 0}
+
+    @staticmethod
+    def limits(host):
+        host = (host or "").lower().rstrip(".")
+        per_min, burst = SMTP_DEFAULT_LIMIT
+        for suffix, limit in SMTP_PROVIDER_LIMITS.items():
+            if host == suffix or host.endswith("." + suffix):
+                per_min, burst = limit
+                break
+        per_min = float(os.environ.get("SMTP_RATE_PER_MIN", per_min))
+        burst = float(os.environ.get("SMTP_BURST", burst))
+        return per_min, burst
+
+    def _bucket(self, host):
+        per_min, burst = self.limits(host)
+        bucket = self._buckets.get(host)
+        if bucket is None or bucket.rate != per_min / 60.0 or bucket.capacity != burst:
+            bucket = self._buckets[host] = TokenBucket(per_min / 60.0, burst)
+        return bucket
+
+    def delay(self, host):
+        """Seconds until a message may go to `host`; 0 means send now (and a token was taken)."""
+        with self._lock:
+            paused = self._paused_until.get(host, 0) - time.monotonic()
+            bucket = self._bucket(host)
+            if paused <= 0:
+                wait = bucket.try_acquire()
+            else:
+                wait = paused
+            if wait:
+                self.stats["deferred"] += 1
+            return wait
+
+    @staticmethod
+    def is_throttle(e):
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return any(code in (421, 451) for code, _ in e.recipients.values())
+        return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code in (421, 451)
+
+    def throttled(self, host):
+        """Pause `host` for all senders; returns the pause in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            if self._paused_until.get(host, 0) > now:
+                # Another worker's send already tripped this pause
+                return self._paused_until[host] - now
+            strikes = self._strikes[host] = self._strikes.get(host, 0) + 1
+            pause = min(SMTP_THROTTLE_MAX_SECS, SMTP_THROTTLE_PAUSE_SECS * 2 ** (strikes - 1))
+            self._paused_until[host] = now + pause
+            self._paused_at[host] = now
+            self.stats["throttled"] += 1
+        return pause
+
+    def succeeded(self, host, started):
+        """A send to host that began at `started` (time.monotonic()) went through."""
+        with self._lock:
+            if started >= self._paused_at.get(host, 0) and self._strikes.pop(host, None):
+                self._paused_until.pop(host, None)
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            hosts = {}
+            for host, bucket in self._buckets.items():
+                with bucket._lock:
+                    bucket._refill()
+                    tokens = bucket.tokens
+                paused = max(0.0, self._paused_until.get(host, 0) - now)
+                hosts[host] = {"tokens": round(tokens, 2), "burst": bucket.capacity,
+                               "rate_per_min": round(bucket.rate * 60, 2),
+                               "paused_for_secs": round(paused, 1), "throttled": paused > 0,
+                               "strikes": self._strikes.get(host, 0)}
+            return dict(self.stats, hosts=hosts)
+
+smtp_limiter = SmtpRateLimiter()
+
+# ==================== MAIL QUEUE ====================
+# Outbound mail is spooled to disk and delivered by background workers, so the
+# watchers and web requests never wait on (or sleep for) a slow SMTP relay.
+
+MAIL_QUEUE_DIR = f"{STATE_DIR}/mail_queue"
+MAIL_WORKERS = int(os.environ.get("MAIL_WORKERS", str(SMTP_POOL_SIZE)))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "6"))
+MAIL_RETRY_BASE_SECS = float(os.environ.get("MAIL_RETRY_BASE_SECS", "30"))
+MAIL_RETRY_MAX_SECS = float(os.environ.get("MAIL_RETRY_MAX_SECS", "3600"))
+MAIL_DEDUPE_SECS = float(os.environ.get("MAIL_DEDUPE_SECS", "86400"))
+
+class MailQueue:
+    """
+    Durable outbound mail spool: one JSON file per message under MAIL_QUEUE_DIR,
+    written before enqueue() returns and removed once delivered. Workers take
+    messages in due order from a heap; failures are rescheduled with
+    exponential backoff (with jitter) and, after MAIL_MAX_ATTEMPTS or a
+    permanent 5xx rejection, moved to dead/ and recorded as failed in the email
+    history. A dedupe_key suppresses a second message with the same key while
+    the first is pending or was delivered within MAIL_DEDUPE_SECS.
+    Delivery is at-least-once: a crash between sending and removing the file
+    resends that message on the next start.
+    """
+
+    def __init__(self, directory=MAIL_QUEUE_DIR, workers=MAIL_WORKERS):
+        self.directory = directory
+        self.dead_dir = os.path.join(directory, "dead")
+        os.makedirs(self.dead_dir, exist_ok=True)
+        self._cond = threading.Condition()
+        self._heap = []  # (next_attempt, message id)
+        self._messages = {}  # pending (including in-flight) messages by id
+        self._keys = {}  # dedupe_key -> pending message id
+        self._recent = {}  # dedupe_key -> wall time it was delivered
+        self._in_flight = set()  # ids popped by a worker and not yet settled
+        self._num_workers = max(1, workers)
+        self._threads = []
+        self._spawned = 0
+        self._stopping = False
+        self.stats = {"enqueued": 0, "sent": 0, "retried": 0, "dead": 0, "deduped": 0}
+        self._load_spool()
+
+    def _path(self, mid, dead=False):
+        return os.path.join(self.dead_dir if dead else self.directory, f"{mid}.json")
+
+    def _load_spool(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    message = json.load(f)
+            except ValueError:
+                log(f"[mail] unreadable spool file {name}, moved to dead/")
+                os.replace(path, os.path.join(self.dead_dir, name))
+                continue
+            self._register(message)
+        if self._messages:
+            log(f"[mail] {len(self._messages)} message(s) waiting in the spool")
+
+    def _register(self, message):
+        self._messages[message["id"]] = message
+        if message.get("dedupe_key"):
+            self._keys[message["dedupe_key"]] = message["id"]
+        heapq.heappush(self._heap, (message["next_attempt"], message["id"]))
+
+    def _persist(self, message, dead=False):
+        path = self._path(message["id"], dead)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(message, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def start(self):
+        """Start workers up to the configured count, replacing any that have died."""
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self._num_workers:
+                self._spawned += 1
+                t = threading.Thread(target=self._worker, daemon=True, name=f"MailWorker-{self._spawned}")
+                self._threads.append(t)
+                t.start()
+
+    def stop(self, timeout=None):
+        """Stop taking messages and wait for in-flight sends to settle. Spooled mail stays for the next start."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._in_flight, timeout)
+
+    def enqueue(self, to_addr, subject, html_body, dedupe_key=None):
+        """Spool a message for delivery; returns its id, or None if dedupe_key suppressed it."""
+        now = time.time()
+        with self._cond:
+            if dedupe_key:
+                delivered = self._recent.get(dedupe_key)
+                if dedupe_key in self._keys or (delivered is not None and now - delivered < MAIL_DEDUPE_SECS):
+                    self.stats["deduped"] += 1
+                    return None
+            mid = f"{int(now * 1000):013d}-{os.urandom(4).hex()}"
+            message = {"id": mid, "to": to_addr, "subject": subject, "html": html_body,
+                       "dedupe_key": dedupe_key, "created": now, "next_attempt": now,
+                       "attempts": 0, "last_error": None}
+            self._persist(message)
+            self._register(message)
+            self.stats["enqueued"] += 1
+            self._cond.notify()
+        return mid
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._stopping:
+                    self._cond.wait()
+                    continue
+                if self._heap and self._heap[0][0] <= now:
+                    _, mid = heapq.heappop(self._heap)
+                    self._in_flight.add(mid)
+                    return self._messages[mid]
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _worker(self):
+        while True:
+            message = self._next()
+            try:
+                self._process(message)
+            except Exception as e:
+                # Bookkeeping failed (disk full, history write...): keep the worker alive
+                self._recover(message, e)
+
+    def _process(self, message):
+        host = SmtpPool._settings()[0]
+        # Hold the message until the host's bucket (or a throttle pause) lets it go
+        while True:
+            wait = smtp_limiter.delay(host)
+            if not wait:
+                break
+            with self._cond:
+                if self._stopping:
+                    # Shutting down: put it back for the next start
+                    self._in_flight.discard(message["id"])
+                    self._register(message)
+                    self._cond.notify_all()
+                    return
+                self._cond.wait(min(wait, 5))
+        started = time.monotonic()
+        try:
+            _smtp_send(message["to"], message["subject"], message["html"])
+        except Exception as e:
+            if smtp_limiter.is_throttle(e):
+                self._throttled(message, host, e)
+            else:
+                self._failed(message, e)
+        else:
+            smtp_limiter.succeeded(host, started)
+            self._delivered(message)
+
+    def _recover(self, message, e):
+        log(f"[mail] error handling {message['subject']} → {message['to']}: {e}")
+        with self._cond:
+            mid = message["id"]
+            if mid not in self._in_flight:
+                return  # already delivered, dead-lettered or requeued before the error
+            self._in_flight.discard(mid)
+            if mid in self._messages:
+                self._register(dict(self._messages[mid], next_attempt=time.time() + MAIL_RETRY_BASE_SECS))
+                self._cond.notify()
+
+    def _throttled(self, message, host, e):
+        # The relay is rate limiting us, not rejecting the message: pause the
+        # host for every worker and requeue without spending an attempt
+        pause = smtp_limiter.throttled(host)
+        message = dict(message, next_attempt=time.time() + pause, last_error=_email_error_text(e))
+        self._persist(message)
+        with self._cond:
+            self._in_flight.discard(message["id"])
+            self._register(message)
+            self._cond.notify()
+        log(f"[mail] {host} throttled us ({_email_error_text(e)}); pausing sends for {pause:.0f}s")
+
+    def _forget(self, message):
+        self._messages.pop(message["id"], None)
+        if message.get("dedupe_key"):
+            self._keys.pop(message["dedupe_key"], None)
+        self._in_flight.discard(message["id"])
+
+    def _delivered(self, message):
+        try:
+            os.remove(self._path(message["id"]))
+        except FileNotFoundError:
+            pass
+        with self._cond:
+            self._forget(message)
+            if message.get("dedupe_key"):
+                now = time.time()
+                self._recent[message["dedupe_key"]] = now
+                if len(self._recent) > 1000:
+                    self._recent = {k: t for k, t in self._recent.items() if now - t < MAIL_DEDUPE_SECS}
+            self.stats["sent"] += 1
+        log_email_sent(message["to"], message["subject"], "success")
+        log(f"[SUCCESS] Email sent: {message['subject']} → {message['to']}")
+
+    @staticmethod
+    def _permanent(e):
+        # 5xx rejections won't succeed on retry; auth failures may once the settings are fixed.
+        # A refused recipient is only final if every refusal is 5xx (450/452 greylisting, full mailbox: retry)
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return bool(e.recipients) and all(code >= 500 for code, _ in e.recipients.values())
+        return (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+                and not isinstance(e, smtplib.SMTPAuthenticationError))
+
+    def _failed(self, message, e):
+        error_msg = _email_error_text(e)
+        message = dict(message, attempts=message["attempts"] + 1, last_error=error_msg)
+        if self._permanent(e) or message["attempts"] >= MAIL_MAX_ATTEMPTS:
+            self._persist(message, dead=True)
+            try:
+                os.remove(self._path(message["id"]))
+            except FileNotFoundError:
+                pass
+            with self._cond:
+                self._forget(message)
+                self.stats["dead"] += 1
+            log_email_sent(message["to"], message["subject"], "failed", error_msg)
+            log(f"[ERROR] Email send failed after {message['attempts']} attempt(s): "
+                f"{message['subject']} → {message['to']}: {error_msg}")
+            return
+        delay = min(MAIL_RETRY_MAX_SECS, MAIL_RETRY_BASE_SECS * 2 ** (message["attempts"] - 1))
+        message["next_attempt"] = time.time() + delay * random.uniform(0.8, 1.2)
+        self._persist(message)
+        with self._cond:
+            self._in_flight.discard(message["id"])
+            self._register(message)
+            self.stats["retried"] += 1
+            self._cond.notify()
+        log(f"[mail] attempt {message['attempts']} failed for {message['subject']} → {message['to']}: "
+            f"{error_msg}; retrying in {delay:.0f}s")
+
+    def status(self):
+        now = time.time()
+        with self._cond:
+            pending = list(self._messages.values())
+            status = dict(self.stats, depth=len(pending), in_flight=len(self._in_flight),
+                          due=sum(1 for m in pending if m["next_attempt"] <= now),
+                          oldest_age_secs=round(now - min(m["created"] for m in pending), 1) if pending else 0,
+                          workers=sum(1 for t in self._threads if t.is_alive()))
+        status["dead_letters"] = sum(1 for n in os.listdir(self.dead_dir) if n.endswith(".json"))
+        return status
+
+_mail_queue = None
+_mail_queue_lock = threading.Lock()
+
+def mail_queue():
+    """The process-wide MailQueue, with its workers running."""
+    global _mail_queue
+    if _mail_queue is None:
+        with _mail_queue_lock:
+            if _mail_queue is None:
+                _mail_queue = MailQueue()
+    _mail_queue.start()
+    return _mail_queue
+
+def send_email(to_addr, subject, html_body, dedupe_key=None):
+    """Queue an email for background delivery; returns the message id (None if deduplicated)."""
+    return mail_queue().enqueue(to_addr, subject, html_body, dedupe_key=dedupe_key)
 
 def log_email_sent(to_addr, subject, status="success", error_msg=None):
     """Log email send attempt to history"""
-    state = load_state()
     email_log = {
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "to": to_addr,
@@ -342,13 +2469,7 @@ def log_email_sent(to_addr, subject, status="success", error_msg=None):
         "status": status,
         "error": error_msg
     }
-    state["email_history"].append(email_log)
-    
-    # Keep only last 500 emails to prevent unbounded growth
-    if len(state["email_history"]) > 500:
-        state["email_history"] = state["email_history"][-500:]
-    
-    save_state(state)
+    email_history_store().append(email_log)
 
 def plex_headers():
     return {
@@ -357,46 +2478,221 @@ def plex_headers():
         "X-Plex-Client-Identifier": "centauri-autoprune",
     }
 
+PLEX_USER_FIELDS = ("id", "title", "username", "email", "thumb", "friend", "home", "createdAt")
+
+class PlexUser:
+    """
+    Compact, slot-backed Plex user record. Supports the dict-style access
+    (u["email"], u.get("title")) callers used when users were plain dicts.
+    """
+    __slots__ = PLEX_USER_FIELDS
+
+    def __init__(self, attrib):
+        for field in PLEX_USER_FIELDS:
+            value = attrib.get(field)
+            # friend/home are "0"/"1" on every row; share one string object
+            if field in ("friend", "home") and value is not None:
+                value = sys.intern(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in PLEX_USER_FIELDS}
+
+    def __repr__(self):
+        return f"PlexUser({self.to_dict()!r})"
+
+def _stream_xml(response, chunk_size=64 * 1024):
+    """
+    Incrementally parse an XML response, yielding (event, element, depth) for
+    "start"/"end" events. The body is never held in full: finished children of
+    the root are cleared as soon as their "end" event has been yielded.
+    """
+    from xml.etree import ElementTree as ET
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    depth = 0
+    try:
+        def _drain():
+            nonlocal root, depth
+            for event, elem in parser.read_events():
+                if event == "start":
+                    depth += 1
+                    if root is None:
+                        root = elem
+                    yield event, elem, depth
+                else:
+                    yield event, elem, depth
+                    depth -= 1
+                    if depth == 1:
+                        root.clear()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            parser.feed(chunk)
+            yield from _drain()
+        parser.close()
+        yield from _drain()
+    finally:
+        response.close()
+
 @retry_on_failure(max_retries=3, delay=2, exceptions=(requests.exceptions.RequestException,))
 def plex_get_users():
-    """Get all Plex users with retry logic"""
+    """Get all Plex users with retry logic, streamed into PlexUser records"""
     # https://plex.tv/api/users
-    r = safe_request("https://plex.tv/api/users", headers=plex_headers())
+    r = safe_request("https://plex.tv/api/users", headers=plex_headers(), stream=True)
     if r is None:
         raise RuntimeError("Failed to connect to Plex API")
     
-    from xml.etree import ElementTree as ET
-    root = ET.fromstring(r.text)
     users = []
-    for u in root.findall("User"):
-        users.append({
-            "id": u.attrib.get("id"),
-            "title": u.attrib.get("title"),
-            "username": u.attrib.get("username"),
-            "email": u.attrib.get("email"),
-            "thumb": u.attrib.get("thumb"),
-            "friend": u.attrib.get("friend"),         # "1" if shared
-            "home": u.attrib.get("home"),
-            "createdAt": u.attrib.get("createdAt")
-        })
+    for event, elem, depth in _stream_xml(r):
+        if event == "start" and depth == 2 and elem.tag == "User":
+            users.append(PlexUser(elem.attrib))
     return users
 
+# ---- Plex user directory cache ----
+def _users_fingerprint(users):
+    """Digest of the fields join detection cares about (id and display fields)."""
+    digest = hashlib.sha1()
+    for u in users:
+        digest.update("\x1f".join(u[f] or "" for f in ("id", "title", "username", "email")).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+def membership_delta(current, welcomed, removed, previous, departed):
+    """
+    Set-based join detection over user id collections.
+    current/previous are this tick's and last tick's Plex ids; welcomed, removed
+    and departed are the state dicts. Returns joined (never seen), rejoined
+    (back after a removal), departed (left Plex without being removed) and
+    returned (back after departing) id sets.
+    """
+    current = current.keys() if isinstance(current, dict) else set(current)
+    return {
+        "joined": current - welcomed.keys() - removed.keys(),
+        "rejoined": current & removed.keys(),
+        "departed": (set(previous) - current) - removed.keys() - departed.keys(),
+        "returned": current & departed.keys(),
+    }
+
+PLEX_USERS_TTL_SECS = int(os.environ.get("PLEX_USERS_TTL_SECS", "60"))
+
+class PlexUserDirectory:
+    """
+    TTL cache over plex_get_users() with O(1) lookup by id, email and username.
+    Refreshes are single-flight: concurrent callers wait for the one fetch in
+    progress instead of each downloading the users XML. Call invalidate() after
+    anything that changes Plex membership.
+    """
+
+    def __init__(self, ttl=PLEX_USERS_TTL_SECS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._generation = 0
+        self._invalidations = 0
+        self._fetched_at = 0.0
+        self._token = None
+        self._users = []
+        self._fingerprint = None
+        self._by_id = {}
+        self._by_email = {}
+        self._by_username = {}
+
+    def _is_fresh(self, max_age):
+        return (self._generation > 0
+                and self._token == os.environ.get("PLEX_TOKEN", PLEX_TOKEN)
+                and time.time() - self._fetched_at < max_age)
+
+    def _refresh(self, max_age):
+        generation = self._generation
+        with self._refresh_lock:
+            # Someone else refreshed while we waited - use their result unless it was invalidated
+            if (self._generation != generation and self._fetched_at) or self._is_fresh(max_age):
+                return
+            token = os.environ.get("PLEX_TOKEN", PLEX_TOKEN)
+            # A fetch that overlaps invalidate() may predate the change it announced
+            # (e.g. still list a user just removed); fetch again rather than cache it
+            for _ in range(3):
+                with self._lock:
+                    epoch = self._invalidations
+                users = plex_get_users()
+                with self._lock:
+                    current = epoch == self._invalidations
+                if current:
+                    break
+            by_id, by_email, by_username = {}, {}, {}
+            for u in users:
+                by_id[str(u["id"])] = u
+                if u.get("email"):
+                    by_email.setdefault(u["email"].lower(), u)
+                if u.get("username"):
+                    by_username.setdefault(u["username"].lower(), u)
+            with self._lock:
+                self._users = users
+                self._fingerprint = _users_fingerprint(users)
+                self._by_id, self._by_email, self._by_username = by_id, by_email, by_username
+                self._token = token
+                # Still overlapping invalidations after retrying: serve it, but don't call it fresh
+                self._fetched_at = time.time() if epoch == self._invalidations else 0.0
+                self._generation += 1
+
+    def users(self, max_age=None):
+        """All Plex users, refetched when older than max_age (defaults to the TTL; 0 forces a refresh)."""
+        if max_age is None:
+            max_age = self.ttl
+        if not self._is_fresh(max_age):
+            self._refresh(max_age)
+        return self._users
+
+    def fingerprint(self):
+        """Hash of the membership fields of the last fetch; unchanged hash means unchanged users."""
+        return self._fingerprint
+
+    def by_id(self):
+        """{user id: PlexUser} for the last fetch. Treat as read-only."""
+        return self._by_id
+
+    def get(self, user_id):
+        self.users()
+        return self._by_id.get(str(user_id))
+
+    def by_email(self, email):
+        self.users()
+        return self._by_email.get((email or "").lower())
+
+    def by_username(self, username):
+        self.users()
+        return self._by_username.get((username or "").lower())
+
+    def invalidate(self):
+        with self._lock:
+            self._invalidations += 1
+            self._fetched_at = 0.0
+
+plex_directory = PlexUserDirectory()
+
 @retry_on_failure(max_retries=3, delay=2, exceptions=(requests.exceptions.RequestException, RuntimeError))
 def plex_machine_id():
     """Find Plex server machineIdentifier with retry logic"""
     # find our server machineIdentifier
-    sr = safe_request("https://plex.tv/api/servers", headers=plex_headers())
+    sr = safe_request("https://plex.tv/api/servers", headers=plex_headers(), stream=True)
     if sr is None:
         raise RuntimeError("Failed to connect to Plex API")
     
-    from xml.etree import ElementTree as ET
-    root = ET.fromstring(sr.text)
     # If server name not specified, pick the first claimed
     cand = None
-    for s in root.findall("Server"):
-        if not PLEX_SERVER_NAME or s.attrib.get("name")==PLEX_SERVER_NAME:
-            cand = s.attrib.get("machineIdentifier")
-            if PLEX_SERVER_NAME: break
+    for event, elem, depth in _stream_xml(sr):
+        if event == "start" and depth == 2 and elem.tag == "Server":
+            if not PLEX_SERVER_NAME or elem.attrib.get("name")==PLEX_SERVER_NAME:
+                cand = elem.attrib.get("machineIdentifier")
+                if PLEX_SERVER_NAME: break
     if not cand:
         raise RuntimeError("Could not find Plex server machineIdentifier; check PLEX_SERVER_NAME.")
     return cand
@@ -406,32 +2702,78 @@ def plex_shared_map(machine_id):
     """Get shared server mapping with retry logic"""
     # https://plex.tv/api/servers/<machineIdentifier>/shared_servers
     url = f"https://plex.tv/api/servers/{machine_id}/shared_servers"
-    rr = safe_request(url, headers=plex_headers())
+    rr = safe_request(url, headers=plex_headers(), stream=True)
     if rr is None:
         raise RuntimeError(f"Failed to get shared servers for machine {machine_id}")
     
-    from xml.etree import ElementTree as ET
-    root = ET.fromstring(rr.text)
     m = {}
-    for ss in root.findall("SharedServer"):
-        shared_id = ss.attrib.get("id")
-        for lu in ss.findall("SharedUser"):
-            uid = lu.attrib.get("id")
-            m[uid] = shared_id
+    shared_id = None
+    for event, elem, depth in _stream_xml(rr):
+        if event != "start":
+            continue
+        if depth == 2 and elem.tag == "SharedServer":
+            shared_id = elem.attrib.get("id")
+        elif depth == 3 and elem.tag == "SharedUser":
+            m[elem.attrib.get("id")] = shared_id
     return m
 
+# ---- Server topology cache ----
+class PlexServerTopology:
+    """
+    Cached machineIdentifier and shared-server map used by removals.
+    The machine id is kept until the token or server name changes; the shared
+    map is fetched lazily, at most once per tick (see new_tick), and dropped
+    whenever a delete fails so the next removal re-reads it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._machine_key = None
+        self._machine_id = None
+        self._shared_map = None
+
+    def machine_id(self):
+        key = (os.environ.get("PLEX_TOKEN", PLEX_TOKEN), PLEX_SERVER_NAME)
+        with self._lock:
+            if self._machine_id is None or self._machine_key != key:
+                self._machine_id = plex_machine_id()
+                self._machine_key = key
+                self._shared_map = None
+            return self._machine_id
+
+    def shared_map(self):
+        machine_id = self.machine_id()
+        with self._lock:
+            if self._shared_map is None:
+                self._shared_map = plex_shared_map(machine_id)
+            return self._shared_map
+
+    def new_tick(self):
+        with self._lock:
+            self._shared_map = None
+
+    def invalidate(self):
+        with self._lock:
+            self._machine_id = None
+            self._shared_map = None
+
+plex_topology = PlexServerTopology()
+
 @retry_on_failure(max_retries=2, delay=1, exceptions=(requests.exceptions.RequestException,))
-def plex_remove_user(user_id, shared_id_map):
+def plex_remove_user(user_id, shared_id_map=None):
     """Remove user from Plex with retry logic"""
     # try DELETE /api/friends/<id>, fallback to /api/shared_servers/<id>
     url = f"https://plex.tv/api/friends/{user_id}"
     r = safe_request(url, method='DELETE', headers=plex_headers())
     if r and r.status_code in (200,204):
         return True
+    # Only the fallback needs the shared-server map
+    if shared_id_map is None:
+        shared_id_map = plex_topology.shared_map()
     sid = shared_id_map.get(user_id)
     if sid:
         r = safe_request(f"https://plex.tv/api/shared_servers/{sid}", method='DELETE', headers=plex_headers())
-        return r and r.status_code in (200,204)
+        return bool(r and r.status_code in (200,204))
     return False
 
 def import_existing_users_as_welcomed():
@@ -442,32 +2784,33 @@ def import_existing_users_as_welcomed():
     """
     try:
         log("Importing existing Plex users as already welcomed...")
-        users = plex_get_users()
-        state = load_state()
+        users = plex_directory.users()
         
         imported_count = 0
-        for user in users:
-            user_id = user.get("id")
-            email = user.get("email", "").lower().strip()
-            username = user.get("title", "Unknown")
-            
-            # Skip if already welcomed
-            if user_id in state["welcomed"]:
-                continue
+        with state_manager().transaction() as state:
+            welcomed = dict(state["welcomed"])
+            for user in users:
+                user_id = user.get("id")
+                email = user.get("email", "").lower().strip()
+                username = user.get("title", "Unknown")
+                
+                # Skip if already welcomed
+                if user_id in welcomed:
+                    continue
+                
+                # Mark as welcomed with import timestamp
+                welcomed[user_id] = {
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "email": email,
+                    "username": username,
+                    "imported": True  # Flag to indicate this was an import, not actual welcome
+                }
+                imported_count += 1
+                log(f"Imported existing user: {username} ({email})")
             
-            # Mark as welcomed with import timestamp
-            state["welcomed"][user_id] = {
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "email": email,
-                "username": username,
-                "imported": True  # Flag to indicate this was an import, not actual welcome
-            }
-            imported_count += 1
-            log(f"Imported existing user: {username} ({email})")
-        
-        # Mark first run as complete
-        state["first_run_complete"] = True
-        save_state(state)
+            state["welcomed"] = welcomed
+            # Mark first run as complete
+            state["first_run_complete"] = True
         
         log(f"Successfully imported {imported_count} existing users as welcomed")
         return imported_count
@@ -476,19 +2819,67 @@ def import_existing_users_as_welcomed():
         traceback.print_exc()
         return 0
 
-def remove_friend(acct, user_id):
-    """Remove a user from Plex server access"""
+def remove_friend(user_id, on_removed=None):
+    """
+    Remove a user from Plex server access (uses the cached server topology, no MyPlex sign-in).
+    on_removed() runs after a successful DELETE but before the users cache is
+    invalidated, so the removal can be recorded before anyone sees the user gone.
+    """
     try:
-        # Get machine ID and shared server mapping
-        machine_id = plex_machine_id()
-        shared_map = plex_shared_map(machine_id)
-        
-        # Use the existing plex_remove_user function
-        return plex_remove_user(user_id, shared_map)
+        ok = plex_remove_user(user_id)
+        if ok:
+            try:
+                if on_removed:
+                    on_removed()
+            finally:
+                plex_directory.invalidate()
+        else:
+            plex_topology.invalidate()
+        return ok
     except Exception as e:
+        plex_topology.invalidate()
         log(f"[remove_friend] error removing user {user_id}: {e}")
         return False
 
+# ---- Removal executor ----
+REMOVAL_WORKERS = int(os.environ.get("REMOVAL_WORKERS", "4"))
+REMOVAL_RATE_PER_SEC = float(os.environ.get("REMOVAL_RATE_PER_SEC", "2"))  # 0 or less = unthrottled
+_removals_in_progress = set()
+_removals_lock = threading.Lock()
+
+def removals_in_progress():
+    """Ids whose removal has been scheduled by execute_removals() and not finished yet."""
+    with _removals_lock:
+        return set(_removals_in_progress)
+
+def execute_removals(kicks, on_removed=None):
+    """
+    Run a tick's removals on a bounded worker pool (REMOVAL_WORKERS) throttled
+    by a token bucket (REMOVAL_RATE_PER_SEC; 0 or less removes without
+    throttling). kicks are dicts with at least "uid";
+    on_removed(kick) is called as soon as each removal succeeds.
+    Returns [(kick, ok)] in input order.
+    """
+    if not kicks:
+        return []
+    bucket = TokenBucket(REMOVAL_RATE_PER_SEC, capacity=REMOVAL_WORKERS) if REMOVAL_RATE_PER_SEC > 0 else None
+    with _removals_lock:
+        _removals_in_progress.update(kick["uid"] for kick in kicks)
+
+    def _remove(kick):
+        try:
+            if bucket is not None:
+                bucket.acquire()
+            return remove_friend(kick["uid"], on_removed=(lambda: on_removed(kick)) if on_removed else None)
+        finally:
+            with _removals_lock:
+                _removals_in_progress.discard(kick["uid"])
+
+    log(f"[removal] removing {len(kicks)} user(s) with {min(REMOVAL_WORKERS, len(kicks))} worker(s)")
+    with ThreadPoolExecutor(max_workers=max(1, min(REMOVAL_WORKERS, len(kicks))), thread_name_prefix="removal") as pool:
+        results = list(pool.map(_remove, kicks))
+    return list(zip(kicks, results))
+
 @retry_on_failure(max_retries=3, delay=2, exceptions=(requests.exceptions.RequestException, RuntimeError))
 def tautulli(cmd, **params):
     """Call Tautulli API with retry logic and error handling"""
@@ -527,6 +2918,180 @@ def tautulli_last_watch(user_id):
         log(f"[ERROR] Failed to get last watch time for user {user_id}: {str(e)}")
         return None
 
+TAUTULLI_PAGE_SIZE = int(os.environ.get("TAUTULLI_PAGE_SIZE", "500"))
+
+def tautulli_last_watch_index():
+    """
+    Build a {tautulli user_id: last watch datetime} index in one paged pass.
+    Reads last_seen from get_users_table, so a scan costs one request per page
+    instead of one get_history call per user. Users who never watched map to None.
+    """
+    index = {}
+    start = 0
+    while True:
+        page = tautulli("get_users_table", start=start, length=TAUTULLI_PAGE_SIZE,
+                        order_column="last_seen", order_dir="desc")
+        rows = page.get("data", []) if isinstance(page, dict) else (page or [])
+        for row in rows:
+            tid = row.get("user_id")
+            if tid is None:
+                continue
+            ts = row.get("last_seen")
+            try:
+                index[str(tid)] = datetime.fromtimestamp(int(ts), tz=timezone.utc) if ts else None
+            except (TypeError, ValueError):
+                index[str(tid)] = None
+        start += len(rows)
+        total = page.get("recordsFiltered") if isinstance(page, dict) else None
+        if not rows or total is None or start >= int(total):
+            break
+    return index
+
+# Incremental mode keeps a persisted last-watch table plus a history high-water mark
+TAUTULLI_INCREMENTAL_SYNC = os.environ.get("TAUTULLI_INCREMENTAL_SYNC", "true").lower() in ("true", "1", "yes")
+# Rows are written when a session stops, so re-read this far behind the cursor date
+TAUTULLI_HISTORY_OVERLAP_SECS = int(os.environ.get("TAUTULLI_HISTORY_OVERLAP_SECS", "86400"))
+_watch_index_lock = threading.Lock()
+
+def _load_watch_index():
+    if not os.path.exists(WATCH_INDEX_FILE):
+        return None
+    try:
+        with open(WATCH_INDEX_FILE, "r") as f:
+            data = json.load(f)
+        if data.get("cursor") is None or not isinstance(data.get("last_watch"), dict):
+            return None
+        return data
+    except Exception as e:
+        log(f"[watch-index] unreadable, rebuilding: {e}")
+        return None
+
+def _save_watch_index(data):
+    tmp = WATCH_INDEX_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, WATCH_INDEX_FILE)
+
+def _watch_index_as_datetimes(last_watch):
+    return {tid: (datetime.fromtimestamp(ts, tz=timezone.utc) if ts else None)
+            for tid, ts in last_watch.items()}
+
+def sync_last_watch_index():
+    """
+    Refresh the persisted last-watch table and return {user_id: datetime}.
+    The first run seeds it from tautulli_last_watch_index(); later runs page
+    get_history newest-first and stop once they pass the stored high-water mark,
+    so each sync costs roughly one request per page of new plays.
+    """
+    with _watch_index_lock:
+        data = _load_watch_index()
+        if data is None:
+            # Take the cursor before the users table so plays in between are re-read next time
+            newest = tautulli("get_history", length=1, order_column="date", order_dir="desc").get("data", [])
+            cursor = {"id": int(newest[0].get("id") or 0), "date": int(newest[0].get("date") or 0)} if newest else {"id": 0, "date": 0}
+            seeded = tautulli_last_watch_index()
+            data = {
+                "cursor": cursor,
+                "last_watch": {tid: int(dt.timestamp()) if dt else None for tid, dt in seeded.items()},
+            }
+            log(f"[watch-index] seeded {len(seeded)} users, cursor={cursor}")
+        else:
+            cursor = data["cursor"]
+            last_watch = data["last_watch"]
+            stop_before = cursor["date"] - TAUTULLI_HISTORY_OVERLAP_SECS
+            new_cursor = dict(cursor)
+            start = 0
+            folded = 0
+            while True:
+                page = tautulli("get_history", start=start, length=TAUTULLI_PAGE_SIZE,
+                                order_column="date", order_dir="desc")
+                rows = page.get("data", [])
+                done = not rows
+                for row in rows:
+                    ts = int(row.get("date") or 0)
+                    if ts < stop_before:
+                        done = True
+                        break
+                    row_id = int(row.get("id") or 0)
+                    if row_id <= cursor["id"]:
+                        continue
+                    tid = str(row.get("user_id"))
+                    if not last_watch.get(tid) or ts > last_watch[tid]:
+                        last_watch[tid] = ts
+                    new_cursor["id"] = max(new_cursor["id"], row_id)
+                    new_cursor["date"] = max(new_cursor["date"], ts)
+                    folded += 1
+                start += len(rows)
+                if done or start >= int(page.get("recordsFiltered") or 0):
+                    break
+            data["cursor"] = new_cursor
+            if folded:
+                log(f"[watch-index] folded {folded} new history rows, cursor={new_cursor}")
+        data["synced_at"] = datetime.now(timezone.utc).isoformat()
+        _save_watch_index(data)
+        return _watch_index_as_datetimes(data["last_watch"])
+
+def last_watch_index():
+    """Last-watch lookup used by the watchers and web UI; honours TAUTULLI_INCREMENTAL_SYNC."""
+    if TAUTULLI_INCREMENTAL_SYNC:
+        return sync_last_watch_index()
+    return tautulli_last_watch_index()
+
+# ---- User activity snapshot ----
+ACTIVITY_SNAPSHOT_TTL_SECS = int(os.environ.get("ACTIVITY_SNAPSHOT_TTL_SECS", "60"))
+
+class UserActivitySnapshot:
+    """Tautulli users and their last watch, indexed by Tautulli user id, email and username."""
+
+    def __init__(self, t_users, watch_index):
+        self.users = t_users
+        self.built_at = time.time()
+        self.by_id = {}
+        self.by_email = {}
+        self.by_username = {}
+        self._last_watch = watch_index
+        for tu in t_users:
+            self.by_id[str(tu.get("user_id"))] = tu
+            email = (tu.get("email") or "").lower()
+            username = (tu.get("username") or "").lower()
+            if email:
+                self.by_email.setdefault(email, tu)
+            if username:
+                self.by_username.setdefault(username, tu)
+
+    def last_watch(self, tautulli_id):
+        return self._last_watch.get(str(tautulli_id))
+
+    def same_activity(self, other):
+        """True when `other` has the same Tautulli users and last-watch table."""
+        return other is not None and self._last_watch == other._last_watch and self.users == other.users
+
+    def match(self, email=None, username=None):
+        """Find the Tautulli user for a Plex email/username; returns (tautulli_user, last_watch)."""
+        tu = self.by_email.get((email or "").lower()) or self.by_username.get((username or "").lower())
+        if tu is None:
+            return None, None
+        return tu, self.last_watch(tu.get("user_id"))
+
+_activity_snapshot = None
+_activity_snapshot_lock = threading.Lock()
+
+def user_activity_snapshot(max_age=None):
+    """
+    Shared activity snapshot for the watchers and web UI.
+    Rebuilt (get_users + last_watch_index) when older than max_age seconds,
+    which defaults to ACTIVITY_SNAPSHOT_TTL_SECS; pass 0 to force a rebuild.
+    """
+    global _activity_snapshot
+    if max_age is None:
+        max_age = ACTIVITY_SNAPSHOT_TTL_SECS
+    with _activity_snapshot_lock:
+        snap = _activity_snapshot
+        if snap is None or time.time() - snap.built_at >= max_age:
+            snap = UserActivitySnapshot(tautulli("get_users"), last_watch_index())
+            _activity_snapshot = snap
+        return snap
+
 # ---- Email templates ----
 # ---------- Email Template Configuration ----------
 
@@ -579,6 +3144,7 @@ def _attribution_footer():
     </div>
     """.strip()
 
+@lru_cache(maxsize=None)
 def _server_emblem_svg(size=28, color=None):
     """Generate SVG icon for email header"""
     if color is None:
@@ -598,6 +3164,7 @@ def _server_emblem_svg(size=28, color=None):
     </svg>
     """.strip()
 
+@lru_cache(maxsize=None)
 def _styles():
     # Light inline CSS; most clients will respect the basics.
     return f"""
@@ -700,6 +3267,84 @@ def _shell(title, subtitle, body_html, accent=None, include_audit=None):
     </div>
     """.strip()
 
+# ---------- Template cache ----------
+EMAIL_TEMPLATE_CHECK_SECS = float(os.environ.get("EMAIL_TEMPLATE_CHECK_SECS", "2"))
+
+class CompiledTemplate:
+    """
+    Template text split once into alternating literal chunks and field names,
+    so rendering is a single join of the chunks with per-recipient values
+    (which the caller has already escaped).
+    """
+
+    _SLOT = "\x00{}\x00"
+
+    def __init__(self, parts):
+        self._parts = parts  # [literal, field, literal, field, ..., literal]
+
+    @classmethod
+    def from_placeholders(cls, text, fields):
+        """Compile custom template text that uses {field} placeholders."""
+        return cls(re.split(r"\{(" + "|".join(map(re.escape, fields)) + r")\}", text))
+
+    @classmethod
+    def from_builder(cls, builder, fields):
+        """Compile a built-in template by rendering its builder once with slot markers."""
+        text = builder(**{field: cls._SLOT.format(field) for field in fields})
+        return cls(re.split("\x00(" + "|".join(map(re.escape, fields)) + ")\x00", text))
+
+    def render(self, values):
+        parts = self._parts[:]
+        parts[1::2] = [values[field] for field in self._parts[1::2]]
+        return "".join(parts)
+
+class EmailTemplateCache:
+    """
+    Compiled email templates by name. A custom file in CUSTOM_TEMPLATE_DIR
+    takes precedence over the built-in template; it is stat'ed at most every
+    EMAIL_TEMPLATE_CHECK_SECS and recompiled only when its mtime or size
+    changes, or when it appears or disappears.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> [checked_at, (mtime_ns, size) or None, CompiledTemplate]
+
+    def get(self, name, builder, fields):
+        now = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and now - entry[0] < EMAIL_TEMPLATE_CHECK_SECS:
+            return entry[2]
+        try:
+            st = os.stat(os.path.join(CUSTOM_TEMPLATE_DIR, f"{name}.html"))
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[1] != stamp:
+                entry = [now, stamp, self._compile(name, builder, fields, stamp)]
+                self._entries[name] = entry
+            entry[0] = now
+            return entry[2]
+
+    @staticmethod
+    def _compile(name, builder, fields, stamp):
+        custom = _load_custom_template(name) if stamp is not None else None
+        if not custom:
+            return CompiledTemplate.from_builder(builder, fields)
+        log(f"[email] compiled custom template {name}.html")
+        # Add attribution before closing body tag
+        if '</body>' in custom:
+            custom = custom.replace('</body>', f'{_attribution_footer()}</body>')
+        return CompiledTemplate.from_placeholders(custom, fields)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+email_templates = EmailTemplateCache()
+
 # ---------- Event templates ----------
 
 def welcome_email_html(display_name: str) -> str:
@@ -708,16 +3353,10 @@ def welcome_email_html(display_name: str) -> str:
     Checks for custom template first (/app/email_templates/welcome.html).
     Falls back to default template if custom not found.
     """
-    # Check for custom template
-    custom_template = _load_custom_template('welcome')
-    if custom_template:
-        # Replace placeholder and add attribution
-        html = custom_template.replace('{display_name}', escape(display_name))
-        # Add attribution before closing body tag
-        if '</body>' in html:
-            html = html.replace('</body>', f'{_attribution_footer()}</body>')
-        return html
-    
+    template = email_templates.get('welcome', _welcome_default_html, ("display_name",))
+    return template.render({"display_name": escape(display_name)})
+
+def _welcome_default_html(display_name):
     # Default template
     body = f"""
 <!DOCTYPE html>
@@ -904,20 +3543,10 @@ def warn_email_html(display_name: str, days: int) -> str:
     Placeholders: {display_name}, {days}, {days_left}
     """
     days_left = KICK_DAYS - days
-    
-    # Check for custom template
-    custom_template = _load_custom_template('warning')
-    if custom_template:
-        # Replace placeholders and add attribution
-        html = (custom_template
-                .replace('{display_name}', escape(display_name))
-                .replace('{days}', str(days))
-                .replace('{days_left}', str(days_left)))
-        # Add attribution before closing body tag
-        if '</body>' in html:
-            html = html.replace('</body>', f'{_attribution_footer()}</body>')
-        return html
-    
+    template = email_templates.get('warning', _warn_default_html, ("display_name", "days", "days_left"))
+    return template.render({"display_name": escape(display_name), "days": str(days), "days_left": str(days_left)})
+
+def _warn_default_html(display_name, days, days_left):
     # Default template
     body = f"""
 <!DOCTYPE html>
@@ -1000,16 +3629,10 @@ def removal_email_html(display_name: str) -> str:
     Falls back to default template if custom not found.
     Placeholder: {display_name}
     """
-    # Check for custom template
-    custom_template = _load_custom_template('removal')
-    if custom_template:
-        # Replace placeholder and add attribution
-        html = custom_template.replace('{display_name}', escape(display_name))
-        # Add attribution before closing body tag
-        if '</body>' in html:
-            html = html.replace('</body>', f'{_attribution_footer()}</body>')
-        return html
-    
+    template = email_templates.get('removal', _removal_default_html, ("display_name",))
+    return template.render({"display_name": escape(display_name)})
+
+def _removal_default_html(display_name):
     # Default template
     body = f"""
 <!DOCTYPE html>
@@ -1086,10 +3709,95 @@ def removal_email_html(display_name: str) -> str:
     """
     return body
 
+# ---- Admin event rows (shared by the per-event admin emails and the digest) ----
+
+def _admin_identity(user):
+    return [("NAME", user.get('title') or user.get('username') or "User"),
+            ("EMAIL", user.get('email') or "Not provided"),
+            ("USER_ID", str(user.get('id') or "N/A"))]
+
+def _admin_event_row(color, heading, fields, timestamp):
+    """One event block: a coloured heading over dotted label/value lines ending in the timestamp."""
+    def label(name):
+        return f"{name} {'·' * max(1, 14 - len(name))}"
+    lines = "".join(f"""
+            <div style="margin-bottom:6px;">{label(k)} {escape(str(v))}</div>""" for k, v in fields)
+    return f"""<table role="presentation" width="100%" style="background:#1a1f26; border-left:3px solid {color}; padding:20px; margin-bottom:20px;">
+        <tr><td>
+          <div style="color:{color}; font-size:14px; font-weight:700; margin-bottom:12px;">{heading}</div>
+          <div style="color:#e5e7eb; font-size:13px; line-height:1.8;">{lines}
+            <div style="color:#6b7280;">{label('TIMESTAMP')} {escape(timestamp)}</div>
+          </div>
+        </td></tr>
+      </table>"""
+
+def admin_join_row(user: dict, rejoined: bool = False, timestamp: str = None) -> str:
+    heading = "↻ EVENT: USER_REJOINED" if rejoined else "✓ EVENT: USER_JOINED"
+    return _admin_event_row("#10b981", heading, _admin_identity(user), timestamp or _now_iso())
+
+def admin_warn_row(user: dict, days: int, timestamp: str = None) -> str:
+    fields = _admin_identity(user) + [("INACTIVE", f"{days} days")]
+    return _admin_event_row("#f59e0b", "⚠ EVENT: USER_WARNED", fields, timestamp or _now_iso())
+
+def admin_removed_row(user: dict, status: str, reason: str = None, timestamp: str = None) -> str:
+    is_success = status.upper() == "SUCCESS"
+    heading = f"{'✓' if is_success else '✗'} STATUS: {'REMOVAL_SUCCESS' if is_success else 'REMOVAL_FAILED'}"
+    fields = _admin_identity(user) + ([("REASON", reason)] if reason else [])
+    return _admin_event_row("#10b981" if is_success else "#dc2626", heading, fields, timestamp or _now_iso())
+
+def admin_digest_html(events: list) -> str:
+    """One admin email for several events (rows from the admin_*_row functions)."""
+    timestamp = _now_iso()
+    counts = {}
+    for event in events:
+        counts[event["kind"]] = counts.get(event["kind"], 0) + 1
+    summary = " · ".join(f"{kind.upper()} {n}" for kind, n in sorted(counts.items()))
+    rows = "\n\n      ".join(event["row"] for event in events)
+    
+    body = f"""
+<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1.0">
+  <title>Centauri — Admin Digest</title>
+</head>
+<body style="margin:0; padding:40px 20px; background:#0a0e14; font-family:'SF Mono', Monaco, 'Cascadia Code', 'Roboto Mono', Consolas, 'Courier New', monospace;">
+  
+  <table role="presentation" width="100%" style="max-width:600px; margin:0 auto; background:#0f1419; border:1px solid #1f2937; border-radius:8px;">
+    <tr><td style="padding:32px;">
+      
+      <!-- HEADER -->
+      <div style="margin-bottom:24px;">
+        <div style="color:#6b7280; font-size:12px; margin-bottom:8px;">$ guardian digest --events={len(events)}</div>
+        <div style="height:2px; background:#1f2937; margin:12px 0;"></div>
+      </div>
+
+      <!-- SUMMARY -->
+      <div style="margin-bottom:20px; padding:12px; background:#1a1f26; border-radius:6px; border:1px solid #374151;">
+        <div style="color:#e5e7eb; font-size:12px; margin-bottom:4px;">{escape(summary)}</div>
+        <div style="color:#6b7280; font-size:11px;">Generated {escape(timestamp)}</div>
+      </div>
+
+      <!-- EVENTS -->
+      {rows}
+
+      <!-- FOOTER -->
+      <div style="height:2px; background:#1f2937; margin:20px 0;"></div>
+      <div style="color:#6b7280; font-size:11px; line-height:1.6;">
+        Centauri Guardian · guardian@centauri<br>
+        Automated user monitoring system
+      </div>
+
+    </td></tr>
+  </table>
+
+</body>
+</html>
+    """
+    return body
+
 def admin_join_html(user: dict) -> str:
-    name = user.get('title') or user.get('username') or "User"
-    email = user.get('email') or "Not provided"
-    uid = user.get('id') or "N/A"
     timestamp = _now_iso()
     
     body = f"""
@@ -1112,17 +3820,7 @@ def admin_join_html(user: dict) -> str:
       </div>
 
       <!-- EVENT -->
-      <table role="presentation" width="100%" style="background:#1a1f26; border-left:3px solid #10b981; padding:20px; margin-bottom:20px;">
-        <tr><td>
-          <div style="color:#10b981; font-size:14px; font-weight:700; margin-bottom:12px;">✓ EVENT: USER_JOINED</div>
-          <div style="color:#e5e7eb; font-size:13px; line-height:1.8;">
-            <div style="margin-bottom:6px;">NAME ·········· {escape(name)}</div>
-            <div style="margin-bottom:6px;">EMAIL ········· {escape(email)}</div>
-            <div style="margin-bottom:6px;">USER_ID ······· {escape(str(uid))}</div>
-            <div style="color:#6b7280;">TIMESTAMP ····· {escape(timestamp)}</div>
-          </div>
-        </td></tr>
-      </table>
+      {admin_join_row(user, timestamp=timestamp)}
 
       <!-- STATUS -->
       <div style="margin-bottom:20px; padding:12px; background:#1a1f26; border-radius:6px; border:1px solid #374151;">
@@ -1147,12 +3845,9 @@ def admin_join_html(user: dict) -> str:
 
 def admin_removed_html(user: dict, reason: str, status: str) -> str:
     name = user.get('title') or user.get('username') or "User"
-    email = user.get('email') or "Not provided"
-    uid = user.get('id') or "N/A"
     timestamp = _now_iso()
     is_success = status.upper() == "SUCCESS"
     border_color = "#10b981" if is_success else "#dc2626"
-    status_text = "REMOVAL_SUCCESS" if is_success else "REMOVAL_FAILED"
     
     body = f"""
 <!DOCTYPE html>
@@ -1174,17 +3869,7 @@ def admin_removed_html(user: dict, reason: str, status: str) -> str:
       </div>
 
       <!-- EVENT -->
-      <table role="presentation" width="100%" style="background:#1a1f26; border-left:3px solid {border_color}; padding:20px; margin-bottom:20px;">
-        <tr><td>
-          <div style="color:{border_color}; font-size:14px; font-weight:700; margin-bottom:12px;">{'✓' if is_success else '✗'} STATUS: {status_text}</div>
-          <div style="color:#e5e7eb; font-size:13px; line-height:1.8;">
-            <div style="margin-bottom:6px;">NAME ·········· {escape(name)}</div>
-            <div style="margin-bottom:6px;">EMAIL ········· {escape(email)}</div>
-            <div style="margin-bottom:6px;">USER_ID ······· {escape(str(uid))}</div>
-            <div style="color:#6b7280;">TIMESTAMP ····· {escape(timestamp)}</div>
-          </div>
-        </td></tr>
-      </table>
+      {admin_removed_row(user, status, timestamp=timestamp)}
 
       <!-- REASON -->
       <div style="margin-bottom:20px; padding:12px; background:#1a1f26; border-radius:6px; border:1px solid #374151;">
@@ -1214,19 +3899,389 @@ def admin_removed_html(user: dict, reason: str, status: str) -> str:
     return body
 # ---------- End Centauri Email UI ----------
 
+# ---- Admin notifications ----
+ADMIN_NOTIFY_MODE = os.environ.get("ADMIN_NOTIFY_MODE", "each").lower()  # each | tick | scheduled
+ADMIN_DIGEST_INTERVAL_SECS = int(os.environ.get("ADMIN_DIGEST_INTERVAL_SECS", "3600"))
+ADMIN_DIGEST_FILE = f"{STATE_DIR}/admin_digest.json"
+# Digest batch per event kind: each watcher flushes only the events it produced
+ADMIN_DIGEST_BATCHES = {"joined": "join", "rejoined": "join",
+                        "warned": "inactive", "removed": "inactive", "removal_failed": "inactive"}
+
+class AdminNotifier:
+    """
+    Routes admin notices. ADMIN_NOTIFY_MODE=each sends every event as its own
+    email (the original behaviour); "tick" collects a watcher tick's events into
+    one digest sent when the tick ends; "scheduled" sends the digest at most
+    every ADMIN_DIGEST_INTERVAL_SECS. Events are batched by the watcher that
+    produces them (ADMIN_DIGEST_BATCHES), so one watcher's tick never sends
+    another's half-collected events. Pending digest events are kept in
+    ADMIN_DIGEST_FILE so a restart doesn't drop them.
+    """
+
+    def __init__(self, path=ADMIN_DIGEST_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._last_sent = {}  # batch -> time.time() of its last digest
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._events = json.load(f)
+            except ValueError:
+                log("[admin] unreadable digest file, starting empty")
+
+    @staticmethod
+    def digest_mode():
+        return ADMIN_NOTIFY_MODE in ("tick", "scheduled")
+
+    def _save(self):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self._events, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def notify(self, kind, subject, html, row, dedupe_key=None):
+        """
+        Record one admin event. html and row are callables producing the
+        stand-alone email and the digest row, so only the one needed is rendered.
+        """
+        if not self.digest_mode():
+            return send_email(ADMIN_EMAIL, subject, html(), dedupe_key=dedupe_key)
+        with self._lock:
+            if dedupe_key and any(e.get("key") == dedupe_key for e in self._events):
+                return None
+            self._events.append({"kind": kind, "subject": subject, "row": row(), "key": dedupe_key,
+                                 "at": datetime.now(timezone.utc).isoformat()})
+            self._save()
+
+    def end_tick(self, batch):
+        """Called at the end of each tick of the watcher owning `batch`; sends its digest when due."""
+        last_sent = self._last_sent.setdefault(batch, time.time())
+        if ADMIN_NOTIFY_MODE == "tick" or (ADMIN_NOTIFY_MODE == "scheduled" and
+                                           time.time() - last_sent >= ADMIN_DIGEST_INTERVAL_SECS):
+            self.flush(batch)
+
+    @staticmethod
+    def _batch(event):
+        return ADMIN_DIGEST_BATCHES.get(event["kind"], "inactive")
+
+    def flush(self, batch=None):
+        """Send the events collected so far for `batch` (all batches if None) as one digest email."""
+        with self._lock:
+            events = [e for e in self._events if batch is None or self._batch(e) == batch]
+            if not events:
+                return None
+            self._events = [e for e in self._events if batch is not None and self._batch(e) != batch]
+            if batch is not None:
+                self._last_sent[batch] = time.time()
+            try:
+                plural = "s" if len(events) != 1 else ""
+                mid = send_email(ADMIN_EMAIL, f"Centauri: Admin digest ({len(events)} event{plural})",
+                                 admin_digest_html(events), dedupe_key=f"digest:{events[0]['at']}:{len(events)}")
+            except Exception:
+                # Keep the events for the next attempt
+                self._events = events + self._events
+                raise
+            self._save()
+        log(f"[admin] digest with {len(events)} event(s) queued")
+        return mid
+
+    def pending(self):
+        with self._lock:
+            return len(self._events)
+
+admin_notifier = AdminNotifier()
+
+# ---- Notification events ----
+# Watchers publish lifecycle events; every subscribed sink handles each event
+# on the bus's worker pool, so one slow or failing notifier neither delays the
+# others nor the watcher loop.
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", "4"))
+NOTIFY_WEBHOOK_URLS = [u.strip() for u in os.environ.get("NOTIFY_WEBHOOK_URLS", "").split(",") if u.strip()]
+NOTIFY_DRAIN_SECS = float(os.environ.get("NOTIFY_DRAIN_SECS", "30"))
+
+class UserEvent:
+    kind = "user"
+    __slots__ = ("uid", "display", "email", "when")
+
+    def __init__(self, uid, display, email, when=None):
+        self.uid = uid
+        self.display = display
+        self.email = email
+        self.when = when or datetime.now(timezone.utc)
+
+    def admin_user(self):
+        return {"id": self.uid, "title": self.display, "email": self.email}
+
+    def to_dict(self):
+        data = {"event": self.kind}
+        for cls in reversed(type(self).__mro__):
+            for field in getattr(cls, "__slots__", ()):
+                data[field] = getattr(self, field)
+        data["when"] = self.when.isoformat()
+        return data
+
+class UserJoined(UserEvent):
+    kind = "user_joined"
+    __slots__ = ("rejoined",)
+
+    def __init__(self, uid, display, email, rejoined=False, when=None):
+        super().__init__(uid, display, email, when)
+        self.rejoined = rejoined
+
+class UserWarned(UserEvent):
+    kind = "user_warned"
+    __slots__ = ("days",)
+
+    def __init__(self, uid, display, email, days, when=None):
+        super().__init__(uid, display, email, when)
+        self.days = days
+
+class UserRemoved(UserEvent):
+    kind = "user_removed"
+    __slots__ = ("reason", "ok")
+
+    def __init__(self, uid, display, email, reason, ok, when=None):
+        super().__init__(uid, display, email, when)
+        self.reason = reason
+        self.ok = ok
+
+class UserEmailSink:
+    """Welcome, warning and removal emails to the user (none after a failed removal)."""
+    name = "email"
+
+    def handle(self, event):
+        if not event.email:
+            return
+        day = f"{event.when:%Y-%m-%d}"
+        if isinstance(event, UserJoined):
+            key = f"rejoin:{event.uid}:{day}" if event.rejoined else f"welcome:{event.uid}"
+            send_email(event.email, "Access confirmed", welcome_email_html(event.display), dedupe_key=key)
+        elif isinstance(event, UserWarned):
+            send_email(event.email, "Inactivity notice", warn_email_html(event.display, event.days),
+                       dedupe_key=f"warn:{event.uid}:{day}")
+        elif isinstance(event, UserRemoved) and event.ok:
+            send_email(event.email, "Access revoked", removal_email_html(event.display),
+                       dedupe_key=f"removal:{event.uid}:{day}")
+        else:
+            return
+        log(f"[notify] {event.kind} email queued -> {event.email}")
+
+class AdminEmailSink:
+    """Admin notices, sent individually or collected into digests by admin_notifier."""
+    name = "admin"
+
+    def handle(self, event):
+        user, day = event.admin_user(), f"{event.when:%Y-%m-%d}"
+        if isinstance(event, UserJoined) and event.rejoined:
+            admin_notifier.notify("rejoined", "Centauri: User rejoined",
+                                  lambda: admin_join_html(user),
+                                  lambda: admin_join_row(user, rejoined=True),
+                                  dedupe_key=f"admin-rejoin:{event.uid}:{day}")
+        elif isinstance(event, UserJoined):
+            admin_notifier.notify("joined", "Centauri: New member onboarded",
+                                  lambda: admin_join_html(user),
+                                  lambda: admin_join_row(user),
+                                  dedupe_key=f"admin-join:{event.uid}")
+        elif isinstance(event, UserWarned):
+            admin_notifier.notify("warned", f"Centauri: Warning sent to {event.display}",
+                                  lambda: f"<p>Warned ~{event.days}d inactive: {event.display} ({event.email or 'no-email'})</p>",
+                                  lambda: admin_warn_row(user, event.days),
+                                  dedupe_key=f"admin-warn:{event.uid}:{day}")
+        elif isinstance(event, UserRemoved):
+            status = "SUCCESS" if event.ok else "FAILED"
+            admin_notifier.notify("removed" if event.ok else "removal_failed", f"Centauri: User removal {status}",
+                                  lambda: admin_removed_html(user, event.reason, status),
+                                  lambda: admin_removed_row(user, status, event.reason),
+                                  dedupe_key=f"admin-removal{'' if event.ok else '-failed'}:{event.uid}:{day}")
+
+class DiscordSink:
+    name = "discord"
+
+    def handle(self, event):
+        if isinstance(event, UserJoined) and event.rejoined:
+            send_discord(f"🔄 User rejoined Plex: {event.display} ({event.email or 'no email'}) - previously removed")
+        elif isinstance(event, UserJoined):
+            send_discord(f"👤 New Plex user joined: {event.display} ({event.email or 'no email'})")
+        elif isinstance(event, UserWarned):
+            send_discord(f"⚠️ Warned {event.display} (~{event.days}d inactive)")
+        elif isinstance(event, UserRemoved):
+            send_discord(f"🗑️ Removal {'✅' if event.ok else '❌'} {event.display} :: {event.reason}")
+
+class WebhookSink:
+    """POSTs each event as JSON ({"event": "user_joined", "uid": ..., ...}) to a URL from NOTIFY_WEBHOOK_URLS."""
+
+    def __init__(self, url):
+        self.url = url
+        self.name = f"webhook:{urlparse(url).netloc}"
+
+    def handle(self, event):
+        r = http_session().post(self.url, json=event.to_dict(), timeout=10)
+        r.raise_for_status()
+
+class NotificationBus:
+    """
+    Fans each published event out to every subscribed sink on a shared thread
+    pool. publish() returns immediately; an exception in one sink is logged and
+    counted against that sink only. wait_idle() lets a watcher wait for its
+    tick's notifications before sending the admin digest.
+    """
+
+    def __init__(self, workers=NOTIFY_WORKERS):
+        self._sinks = []
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="notify")
+        self._cond = threading.Condition()
+        self._pending = 0
+        self.stats = {}  # sink name -> {"delivered": n, "failed": n}
+
+    def subscribe(self, sink):
+        with self._cond:
+            self._sinks.append(sink)
+            self.stats.setdefault(sink.name, {"delivered": 0, "failed": 0})
+
+    def publish(self, event):
+        with self._cond:
+            sinks = list(self._sinks)
+            self._pending += len(sinks)
+        for sink in sinks:
+            self._pool.submit(self._deliver, sink, event)
+
+    def _deliver(self, sink, event):
+        outcome = "delivered"
+        try:
+            sink.handle(event)
+        except Exception as e:
+            outcome = "failed"
+            log(f"[notify] {sink.name} failed for {event.kind} {event.display}: {e}")
+        finally:
+            with self._cond:
+                self._pending -= 1
+                self.stats[sink.name][outcome] += 1
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Block until every published event has been handled by every sink. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def status(self):
+        with self._cond:
+            return {"pending": self._pending, "sinks": {name: dict(s) for name, s in self.stats.items()}}
+
+notification_bus = NotificationBus()
+for _sink in [UserEmailSink(), AdminEmailSink(), DiscordSink()] + [WebhookSink(u) for u in NOTIFY_WEBHOOK_URLS]:
+    notification_bus.subscribe(_sink)
+
+# ---- Inactivity scheduling ----
+INACTIVITY_FULL_SCAN_SECS = int(os.environ.get("INACTIVITY_FULL_SCAN_SECS", "86400"))
+
+def inactivity_deadline(last_watch, warned, removed):
+    """When a user's inactivity verdict next changes: WARN_DAYS, then KICK_DAYS, after last_watch (None = never)."""
+    if last_watch is None or removed:
+        return None
+    if not warned:
+        return last_watch + timedelta(days=WARN_DAYS)
+    return last_watch + timedelta(days=KICK_DAYS)
+
+class InactivityScheduler:
+    """
+    Min-heap of per-user evaluation deadlines for the inactivity watcher. A
+    tick evaluates only users whose deadline has passed plus users whose
+    inputs (Tautulli match and last watch, join time, warned/removed, VIP)
+    changed; a quiet tick costs O(due users). Users handed out by select()
+    stay pending until schedule() is called for them, so a tick that fails
+    part-way retries them next time. Re-scheduling a user leaves the old heap
+    entry behind, and stale entries are skipped when popped.
+    Every INACTIVITY_FULL_SCAN_SECS all users are evaluated as a safety net.
+    """
+
+    def __init__(self, full_scan_secs=INACTIVITY_FULL_SCAN_SECS):
+        self.full_scan_secs = full_scan_secs
+        self._lock = threading.Lock()
+        self._heap = []  # (deadline timestamp, uid)
+        self._deadlines = {}  # uid -> deadline timestamp, or None when nothing is pending
+        self._signatures = {}
+        self._unsettled = set()  # selected but not yet scheduled
+        self._next_full_scan = 0.0
+        self.last_tick = {}
+
+    def select(self, now, inputs_changed, signatures):
+        """
+        Users to evaluate at `now`. inputs_changed says whether anything the
+        signatures depend on may have changed; only then is signatures()
+        called to diff every user.
+        """
+        ts = now.timestamp()
+        with self._lock:
+            changed = set()
+            full = self.full_scan_secs > 0 and ts >= self._next_full_scan
+            if full or inputs_changed:
+                current = signatures()
+                if full:
+                    changed = set(current)
+                    self._next_full_scan = ts + self.full_scan_secs
+                else:
+                    changed = {uid for uid, sig in current.items() if self._signatures.get(uid) != sig}
+                for uid in self._signatures.keys() - current.keys():
+                    self._deadlines.pop(uid, None)
+                self._signatures = current
+            due = set()
+            while self._heap and self._heap[0][0] <= ts:
+                deadline, uid = heapq.heappop(self._heap)
+                if self._deadlines.get(uid) == deadline:
+                    due.add(uid)
+            # Left over from a tick that failed before evaluating them
+            retry = self._unsettled - due - changed
+            self._unsettled = due | changed | retry
+            self.last_tick = {"due": len(due), "changed": len(changed), "retried": len(retry),
+                              "full_scan": full, "evaluated": len(self._unsettled)}
+            return set(self._unsettled)
+
+    def schedule(self, uid, deadline):
+        """Set (or with None, clear) the next evaluation time for uid."""
+        with self._lock:
+            ts = deadline.timestamp() if deadline is not None else None
+            self._unsettled.discard(uid)
+            self._deadlines[uid] = ts
+            if ts is not None:
+                heapq.heappush(self._heap, (ts, uid))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                # Too many stale entries; rebuild from the live deadlines
+                self._heap = [(t, u) for u, t in self._deadlines.items() if t is not None]
+                heapq.heapify(self._heap)
+
+    def force_full_scan(self):
+        with self._lock:
+            self._next_full_scan = 0.0
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            upcoming = [t for t in self._deadlines.values() if t is not None]
+            return {"tracked": len(self._signatures), "scheduled": len(upcoming),
+                    "next_due_in_secs": round(min(upcoming) - now, 1) if upcoming else None,
+                    "last_tick": dict(self.last_tick)}
+
+inactivity_scheduler = InactivityScheduler()
+
 # ---- Core workers ----
 def fast_join_watcher():
     log("[join] loop thread started")
-    state = load_state()
-    welcomed = state.get("welcomed", {})
-    removed = state.get("removed", {})
+    manager = state_manager()
+    state = manager.read()
+    # Ids believed to be on Plex; anyone missing next tick has left on their own
+    previous_ids = set(state["welcomed"]) - set(state["removed"]) - set(state["departed"])
+    last_seen = None
     tick = 0
     while not stop_event.is_set():
+        generation = watcher_wakeup.generation()
         # Check if daemon is enabled
         if not daemon_enabled:
             log("[join] Daemon disabled, waiting...")
-            time.sleep(10)  # Check every 10 seconds
+            watcher_wakeup.wait(generation)  # until enabled, reconfigured or stopped
             continue
+        if watcher_wakeup.take_scan("join"):
+            log("[join] scan requested")
+            last_seen = None
         
         tick += 1
         try:
@@ -1235,24 +4290,48 @@ def fast_join_watcher():
             all_users = None
             for attempt in range(3):
                 try:
-                    all_users = plex_get_users()
+                    all_users = plex_directory.users(max_age=0)
                     break
                 except Exception as e:
                     if attempt < 2:
                         log(f"[join] Plex API error (attempt {attempt+1}/3), retrying in 5s: {e}")
-                        time.sleep(5)
+                        stop_event.wait(5)
                     else:
                         raise
             
             if all_users is None:
                 log("[join] Could not fetch users after 3 attempts, skipping this tick")
                 continue
-                
+
+            # Skip the tick when neither Plex membership nor the sections we read have changed
+            seen = (plex_directory.fingerprint(), manager.revision("welcomed", "removed", "departed"))
+            if seen == last_seen:
+                log("[join] membership unchanged since last tick")
+                continue
+
+            by_id = plex_directory.by_id()
+            # Archived users who are back on Plex get their history back before the diff
+            restore_archived_users(set(by_id) - set(manager.section("welcomed")) - set(manager.section("removed")))
+            welcomed = manager.section("welcomed")
+            removed = manager.section("removed")
+            departed = manager.section("departed")
+            delta = membership_delta(by_id, welcomed, removed, previous_ids, departed)
+            # Users the inactivity watcher is removing right now didn't leave on their own
+            delta["departed"] -= removals_in_progress()
+
             now = datetime.now(timezone.utc)
+            for uid in sorted(delta["departed"]):
+                info = welcomed.get(uid)
+                log(f"[join] DEPARTED: id={uid} left Plex on their own")
+                manager.set_record("departed", uid, {"when": now.isoformat(), "welcomed": info if isinstance(info, str) else None})
+            for uid in sorted(delta["returned"]):
+                log(f"[join] RETURNED: id={uid} is back on Plex after departing")
+                manager.pop_record("departed", uid)
+
             new_count = 0
             rejoined_count = 0
-            for u in all_users:
-                uid = str(u["id"])
+            for uid in sorted(delta["rejoined"] | delta["joined"]):
+                u = by_id[uid]
                 display = u["title"] or u["username"] or "there"
                 email = u["email"]
                 username = u["username"] or ""
@@ -1264,30 +4343,16 @@ def fast_join_watcher():
                     if DRY_RUN:
                         log(f"[DRY RUN] Would move {display} from removed to welcomed and send welcome email")
                     else:
-                        # Send welcome email for rejoined user
-                        if email:
-                            try:
-                                send_email(email, "Access confirmed", welcome_email_html(display))
-                                log(f"[join] welcome sent to rejoined user -> {email}")
-                            except Exception as e:
-                                log(f"[join] welcome email error: {e}")
-                        try:
-                            send_email(ADMIN_EMAIL, "Centauri: User rejoined",
-                                       admin_join_html({"id": uid, "title": display, "email": email}))
-                            log(f"[join] admin notice sent for rejoined user")
-                        except Exception as e:
-                            log(f"[join] admin email error: {e}")
-                        send_discord(f"🔄 User rejoined Plex: {display} ({email or 'no email'}) - previously removed")
+                        # Welcome email, admin notice and Discord go out via the notification bus
+                        notification_bus.publish(UserJoined(uid, display, email, rejoined=True, when=now))
                         
                         # Move from removed to welcomed
-                        del removed[uid]
+                        manager.pop_record("removed", uid)
                     
-                    welcomed[uid] = now.isoformat()
+                    manager.set_record("welcomed", uid, now.isoformat())
                     rejoined_count += 1
                     continue
                 
-                if uid in welcomed:
-                    continue
                 # New user detected (not yet welcomed)
                 log(f"[join] NEW: {display} ({email or 'no email'}) id={uid}")
                 
@@ -1297,7 +4362,7 @@ def fast_join_watcher():
                     if AUTO_WELCOME_DELAY_HOURS > 0:
                         # Store detection time if not already stored
                         if uid not in welcomed:
-                            welcomed[uid] = now.isoformat()
+                            manager.set_record("welcomed", uid, now.isoformat())
                             log(f"[join] User detected, welcome delayed by {AUTO_WELCOME_DELAY_HOURS} hours")
                             continue
                         
@@ -1315,51 +4380,48 @@ def fast_join_watcher():
                     if DRY_RUN:
                         log(f"[DRY RUN] Would send welcome email to {display} ({email or 'no email'})")
                     else:
-                        if email:
-                            try:
-                                send_email(email, "Access confirmed", welcome_email_html(display))
-                                log(f"[join] welcome sent -> {email}")
-                            except Exception as e:
-                                log(f"[join] welcome email error: {e}")
-                        try:
-                            send_email(ADMIN_EMAIL, "Centauri: New member onboarded",
-                                       admin_join_html({"id": uid, "title": display, "email": email}))
-                            log(f"[join] admin notice sent")
-                        except Exception as e:
-                            log(f"[join] admin email error: {e}")
-                        send_discord(f"👤 New Plex user joined: {display} ({email or 'no email'})")
+                        notification_bus.publish(UserJoined(uid, display, email, when=now))
                 else:
                     log(f"[join] AUTO_WELCOME disabled - user tracked but no email sent")
                 
-                welcomed[uid] = now.isoformat()
+                manager.set_record("welcomed", uid, now.isoformat())
                 new_count += 1
             if new_count == 0 and rejoined_count == 0:
                 log("[join] no new users")
             elif rejoined_count > 0:
                 log(f"[join] {rejoined_count} user(s) rejoined, {new_count} new user(s)")
-            state["welcomed"] = welcomed
-            state["removed"] = removed
-            save_state(state)
+            previous_ids = set(by_id)
+            # Taken after our own writes so they don't defeat the skip next tick
+            last_seen = (seen[0], manager.revision("welcomed", "removed", "departed"))
         except Exception as e:
             log(f"[join] error: {e}")
             traceback.print_exc()
-        time.sleep(CHECK_NEW_USERS_SECS)
+        finally:
+            # Runs on every tick, including the ones that end early with `continue`
+            try:
+                # Let this tick's notifications land before a digest goes out
+                notification_bus.wait_idle(timeout=NOTIFY_DRAIN_SECS)
+                admin_notifier.end_tick("join")
+            except Exception as e:
+                log(f"[join] admin digest error: {e}")
+            watcher_wakeup.wait(generation, watcher_interval("CHECK_NEW_USERS_SECS", CHECK_NEW_USERS_SECS))
 
 def slow_inactivity_watcher():
     log("[inactive] loop thread started")
-    state = load_state()
-    warned = state.get("warned", {})
-    removed = state.get("removed", {})
-    welcomed = state.get("welcomed", {})  # Track when users joined
-    server = get_plex_server_resource(get_plex_account())
+    manager = state_manager()
     tick = 0
+    last_fingerprint = last_snapshot = None
 
     while not stop_event.is_set():
+        generation = watcher_wakeup.generation()
         # Check if daemon is enabled
         if not daemon_enabled:
             log("[inactive] Daemon disabled, waiting...")
-            time.sleep(10)  # Check every 10 seconds
+            watcher_wakeup.wait(generation)  # until enabled, reconfigured or stopped
             continue
+        if watcher_wakeup.take_scan("inactive"):
+            log("[inactive] scan requested, evaluating every user")
+            inactivity_scheduler.force_full_scan()
         
         tick += 1
         try:
@@ -1369,12 +4431,12 @@ def slow_inactivity_watcher():
             plex_users = None
             for attempt in range(3):
                 try:
-                    plex_users = plex_get_users()
+                    plex_users = plex_directory.users()
                     break
                 except Exception as e:
                     if attempt < 2:
                         log(f"[inactive] Plex API error (attempt {attempt+1}/3), retrying in 5s: {e}")
-                        time.sleep(5)
+                        stop_event.wait(5)
                     else:
                         raise
             
@@ -1382,44 +4444,66 @@ def slow_inactivity_watcher():
                 log("[inactive] Could not fetch users after 3 attempts, skipping this tick")
                 continue
                 
-            plex_by_email = {(u["email"] or "").lower(): u for u in plex_users}
-            plex_by_username = {(u["username"] or "").lower(): u for u in plex_users}
-
             # Retry logic for Tautulli API calls
-            t_users = None
+            snapshot = None
             for attempt in range(3):
                 try:
-                    t_users = tautulli("get_users")
+                    # One get_users plus one paged last-watch pass, shared with the web UI
+                    snapshot = user_activity_snapshot(max_age=0)
                     break
                 except Exception as e:
                     if attempt < 2:
                         log(f"[inactive] Tautulli API error (attempt {attempt+1}/3), retrying in 5s: {e}")
-                        time.sleep(5)
+                        stop_event.wait(5)
                     else:
                         raise
             
-            if t_users is None:
+            if snapshot is None:
                 log("[inactive] Could not fetch Tautulli users after 3 attempts, skipping this tick")
                 continue
+            warned = manager.section("warned")
+            removed = manager.section("removed")
+            welcomed = manager.section("welcomed")  # Track when users joined
             now = datetime.now(timezone.utc)
             acted = False
+            kicks = []
+            plex_topology.new_tick()
+            plex_by_id = plex_directory.by_id()
+            vip_names = set(get_vip_names())
+
+            def is_vip(pu):
+                return (pu["email"] or "").lower() in VIP_EMAILS or (pu["username"] or "").lower() in vip_names
 
-            for tu in t_users:
-                tid   = tu.get("user_id")
-                tuser = (tu.get("username") or "").lower()
-                temail= (tu.get("email") or "").lower()
+            def signatures():
+                sigs = {}
+                for uid, pu in plex_by_id.items():
+                    tu, last = snapshot.match(pu["email"], pu["username"])
+                    sigs[uid] = (tu.get("user_id") if tu else None, last, pu["createdAt"], welcomed.get(uid),
+                                 uid in warned, uid in removed, is_vip(pu))
+                return sigs
 
-                pu = plex_by_email.get(temail) or plex_by_username.get(tuser)
-                if not pu:
+            # Only users whose deadline has passed or whose inputs changed are evaluated
+            fingerprint = (plex_directory.fingerprint(), manager.revision("welcomed", "warned", "removed"),
+                           tuple(sorted(vip_names)))
+            inputs_changed = fingerprint != last_fingerprint or not snapshot.same_activity(last_snapshot)
+            evaluate = inactivity_scheduler.select(now, inputs_changed, signatures)
+            log(f"[inactive] evaluating {len(evaluate)} of {len(plex_by_id)} users "
+                f"({inactivity_scheduler.last_tick['due']} due, {inactivity_scheduler.last_tick['changed']} changed)")
+
+            for uid in sorted(evaluate):
+                pu = plex_by_id.get(uid)
+                tu = snapshot.match(pu["email"], pu["username"])[0] if pu else None
+                if not tu:
+                    inactivity_scheduler.schedule(uid, None)
                     continue
-                uid = str(pu["id"])
+                tid = tu.get("user_id")
                 display = pu["title"] or pu["username"] or "there"
                 email = pu["email"]
-                username = (pu["username"] or "").lower()
 
                 # Check VIP protection (email or username)
-                if (email or "").lower() in VIP_EMAILS or username in get_vip_names():
+                if is_vip(pu):
                     log(f"[inactive] skip VIP: {display} ({email or 'no-email'})")
+                    inactivity_scheduler.schedule(uid, None)
                     continue
 
                 # Grace period: Skip users who joined within the last 24 hours
@@ -1429,11 +4513,12 @@ def slow_inactivity_watcher():
                         hours_since_join = (now - join_date).total_seconds() / 3600
                         if hours_since_join < 24:
                             log(f"[inactive] skip NEW USER (24hr grace): {display} (joined {hours_since_join:.1f}h ago)")
+                            inactivity_scheduler.schedule(uid, join_date + timedelta(hours=24))
                             continue
                     except Exception:
                         pass
 
-                last_watch = tautulli_last_watch(tid)
+                last_watch = snapshot.last_watch(tid)
                 
                 # For users with no watch history, use their join date as the baseline (after 24hr grace)
                 if last_watch is None and uid in welcomed:
@@ -1457,20 +4542,8 @@ def slow_inactivity_watcher():
                     if DRY_RUN:
                         log(f"[DRY RUN] Would warn {display} ({email or 'no email'}) - {days} days inactive")
                     else:
-                        if email:
-                            try:
-                                send_email(email, "Inactivity notice", warn_email_html(display, days))
-                                log(f"[inactive] warn sent -> {email}")
-                            except Exception as e:
-                                log(f"[inactive] warn email error: {e}")
-                        try:
-                            send_email(ADMIN_EMAIL, f"Centauri: Warning sent to {display}",
-                                       f"<p>Warned ~{days}d inactive: {display} ({email or 'no-email'})</p>")
-                            log("[inactive] admin warn notice sent")
-                        except Exception as e:
-                            log(f"[inactive] admin warn email error: {e}")
-                        send_discord(f"⚠️ Warned {display} (~{days}d inactive)")
-                    warned[uid] = now.isoformat()
+                        notification_bus.publish(UserWarned(uid, display, email, days, when=now))
+                    manager.set_record("warned", uid, now.isoformat())
                     acted = True
 
                 if days >= KICK_DAYS and uid not in removed:
@@ -1478,52 +4551,64 @@ def slow_inactivity_watcher():
                     
                     if DRY_RUN:
                         log(f"[DRY RUN] Would remove {display} ({email or 'no email'}) - {reason}")
-                        ok = False  # Simulated failure in dry run
+                        manager.set_record("removed", uid, {"when": now.isoformat(), "ok": False, "reason": reason})  # Simulated failure in dry run
                     else:
-                        ok = remove_friend(get_plex_account(), uid)
-                        
-                        if ok:
-                            # Removal succeeded - notify user and admin
-                            if email:
-                                try:
-                                    send_email(email, "Access revoked", removal_email_html(display))
-                                    log(f"[inactive] removal notice sent -> {email}")
-                                except Exception as e:
-                                    log(f"[inactive] removal email error: {e}")
-                            try:
-                                send_email(ADMIN_EMAIL, f"Centauri: User removal SUCCESS",
-                                           admin_removed_html({"id":uid,"title":display,"email":email}, reason, "SUCCESS"))
-                                log("[inactive] admin removal SUCCESS notice sent")
-                            except Exception as e:
-                                log(f"[inactive] admin removal email error: {e}")
-                            send_discord(f"🗑️ Removal ✅ {display} :: {reason}")
-                        else:
-                            # Removal failed - only notify admin, don't email the user
-                            log(f"[inactive] removal FAILED for {display} - user NOT notified")
-                            try:
-                                send_email(ADMIN_EMAIL, f"Centauri: User removal FAILED",
-                                           admin_removed_html({"id":uid,"title":display,"email":email}, reason, "FAILED"))
-                                log("[inactive] admin removal FAILED notice sent")
-                            except Exception as e:
-                                log(f"[inactive] admin removal email error: {e}")
-                            send_discord(f"🗑️ Removal ❌ {display} :: {reason}")
-                    
-                    removed[uid] = {"when": now.isoformat(), "ok": ok, "reason": reason}
+                        # Deferred to the removal executor after the scan
+                        kicks.append({"uid": uid, "display": display, "email": email, "reason": reason})
                     acted = True
 
-            state["warned"] = warned
-            state["removed"] = removed
-            state["last_inactivity_scan"] = now.isoformat()
-            save_state(state)
+                # Nothing about this user changes until their next threshold (or new activity)
+                inactivity_scheduler.schedule(uid, inactivity_deadline(
+                    last_watch, uid in warned or days >= WARN_DAYS, uid in removed or days >= KICK_DAYS))
+
+            def record_removal(kick):
+                # Recorded as each DELETE succeeds, so the join watcher never sees a
+                # removed user missing from Plex without a "removed" record
+                manager.set_record("removed", kick["uid"], {"when": now.isoformat(), "ok": True, "reason": kick["reason"]})
+
+            # Run this tick's plex.tv DELETEs concurrently, then notify per outcome
+            for kick, ok in execute_removals(kicks, on_removed=record_removal):
+                uid, display, email, reason = kick["uid"], kick["display"], kick["email"], kick["reason"]
+                if not ok:
+                    # Removal failed - the email sink skips the user, only the admin hears about it
+                    log(f"[inactive] removal FAILED for {display} - user NOT notified")
+                notification_bus.publish(UserRemoved(uid, display, email, reason, ok, when=now))
+                manager.set_record("removed", uid, {"when": now.isoformat(), "ok": ok, "reason": reason})
+
+            # Everything above is coalesced into one debounced flush
+            manager.set_value("last_inactivity_scan", now.isoformat())
+            archive_cold_records({str(u["id"]) for u in plex_users})
             if not acted:
                 log("[inactive] no actions this tick")
+            # Taken after our own writes so they don't count as changes next tick
+            last_fingerprint = (fingerprint[0], manager.revision("welcomed", "warned", "removed"), fingerprint[2])
+            last_snapshot = snapshot
         except Exception as e:
             log(f"[inactive] error: {e}")
             traceback.print_exc()
+        finally:
+            # Runs on every tick, including the ones that end early with `continue`
+            try:
+                # Let this tick's notifications land before a digest goes out
+                notification_bus.wait_idle(timeout=NOTIFY_DRAIN_SECS)
+                admin_notifier.end_tick("inactive")
+            except Exception as e:
+                log(f"[inactive] admin digest error: {e}")
+            watcher_wakeup.wait(generation, watcher_interval("CHECK_INACTIVITY_SECS", CHECK_INACTIVITY_SECS))
+def shutdown():
+    """Stop the watchers and write out everything still buffered in memory. Safe to call twice."""
+    stop_event.set()
+    watcher_wakeup.notify()
+    # Debounced state writes (removals, rejoins...) must reach disk before exit
+    state_manager().flush()
+    if _mail_queue is not None and not _mail_queue.stop(timeout=10):
+        log("[mail] shutdown with sends still in flight; they will be retried on the next start")
+    if _smtp_pool is not None:
+        _smtp_pool.close_all()
+    discord_dispatcher.flush(timeout=5)
 
-        time.sleep(CHECK_INACTIVITY_SECS)
 def handle_signal(sig, frame):
-    stop_event.set()
+    shutdown()
 
 if __name__ == "__main__":
     import sys
@@ -1531,6 +4616,7 @@ if __name__ == "__main__":
     # Check for test command
     if len(sys.argv) > 1 and sys.argv[1] == "test-discord":
         test_discord_notifications()
+        discord_dispatcher.flush(timeout=60)
         sys.exit(0)
     
     log("Centauri Guardian daemon started.")
@@ -1542,6 +4628,7 @@ if __name__ == "__main__":
     
     signal.signal(signal.SIGTERM, handle_signal)
     signal.signal(signal.SIGINT, handle_signal)
+    mail_queue()  # deliver anything left in the spool by a previous run
     t1 = threading.Thread(target=fast_join_watcher, daemon=True)
     t2 = threading.Thread(target=slow_inactivity_watcher, daemon=True)
     t1.start(); t2.start()
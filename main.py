@@ -6,6 +6,7 @@ Starts both the monitoring daemon and web interface in separate threads
 import threading
 import time
 import os
+import signal
 
 def run_daemon():
     """Run the monitoring daemon"""
@@ -16,6 +17,9 @@ def run_daemon():
 
 def run_daemon_threads(daemon_module):
     """Start daemon worker threads"""
+    # Deliver anything left in the mail spool by a previous run
+    daemon_module.mail_queue()
+    
     # Start worker threads (marked as daemon so they won't block program exit)
     t1 = threading.Thread(target=daemon_module.fast_join_watcher, daemon=True, name="JoinWatcher")
     t2 = threading.Thread(target=daemon_module.slow_inactivity_watcher, daemon=True, name="InactivityWatcher")
@@ -67,6 +71,13 @@ def run_web():
         traceback.print_exc()
         raise
 
+def handle_shutdown(signum, frame):
+    """SIGTERM (docker stop) / SIGINT: flush daemon state before exiting"""
+    print(f"\n[LAUNCHER] Signal {signum} received, shutting down", flush=True)
+    import daemon
+    daemon.shutdown()
+    os._exit(0)
+
 
 if __name__ == '__main__':
     print("=" * 70)
@@ -74,6 +85,10 @@ if __name__ == '__main__':
     print("=" * 70)
     print()
     
+    # A default SIGTERM skips atexit, which would drop debounced state writes
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    
     # Start daemon in background thread
     daemon_thread = threading.Thread(target=run_daemon, daemon=True, name="DaemonMain")
     daemon_thread.start()
@@ -93,6 +108,9 @@ if __name__ == '__main__':
         run_web()
     except KeyboardInterrupt:
         print("\n[LAUNCHER] Shutdown requested")
+        # os._exit skips atexit, so flush pending state writes first
+        import daemon
+        daemon.shutdown()
         os._exit(0)
     except Exception as e:
         print(f"\n[LAUNCHER ERROR] Web server failed to start: {e}")
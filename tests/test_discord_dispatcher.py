@@ -0,0 +1,105 @@
+"""
+DiscordDispatcher against a local webhook stub.
+
+Run from the repository root:  python -m pytest tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import daemon  # noqa: E402
+
+
+class WebhookStub:
+    """Records every POST; replies with the scripted (status, body) pairs, then 204."""
+
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+        self.calls = []  # (monotonic time, status, [descriptions])
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, body = stub.replies.pop(0) if stub.replies else (204, None)
+                stub.calls.append((time.monotonic(), status,
+                                   [e["description"] for e in payload["embeds"]]))
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                if data:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DiscordDispatcherTest(unittest.TestCase):
+
+    def start_stub(self, replies=()):
+        stub = WebhookStub(replies)
+        self.addCleanup(stub.close)
+        return stub
+
+    @mock.patch.object(daemon, "DISCORD_BATCH_SECS", 0.2)
+    def test_burst_is_packed_into_embed_batches(self):
+        stub = self.start_stub()
+        dispatcher = daemon.DiscordDispatcher()
+        for i in range(25):
+            dispatcher.enqueue(stub.url, f"event {i}")
+
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual([len(embeds) for _, _, embeds in stub.calls], [10, 10, 5])
+        self.assertEqual([d for _, _, embeds in stub.calls for d in embeds],
+                         [f"event {i}" for i in range(25)])
+        status = dispatcher.status()
+        self.assertEqual((status["sent"], status["calls"], status["dropped"]), (25, 3, 0))
+
+    @mock.patch.object(daemon, "DISCORD_BATCH_SECS", 0.1)
+    def test_429_retry_after_pauses_and_resends_the_batch(self):
+        stub = self.start_stub([(429, {"message": "You are being rate limited.",
+                                       "retry_after": 0.5, "global": False})])
+        dispatcher = daemon.DiscordDispatcher()
+        for i in range(3):
+            dispatcher.enqueue(stub.url, f"event {i}")
+
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual([status for _, status, _ in stub.calls], [429, 204])
+        self.assertEqual(stub.calls[0][2], stub.calls[1][2])
+        self.assertGreaterEqual(stub.calls[1][0] - stub.calls[0][0], 0.5)
+        status = dispatcher.status()
+        self.assertEqual((status["sent"], status["rate_limited"], status["dropped"]), (3, 1, 0))
+
+    @mock.patch.object(daemon, "DISCORD_BATCH_SECS", 0.3)
+    @mock.patch.object(daemon, "DISCORD_QUEUE_MAX", 3)
+    def test_full_queue_drops_the_oldest_message(self):
+        stub = self.start_stub()
+        dispatcher = daemon.DiscordDispatcher()
+        for i in range(5):
+            dispatcher.enqueue(stub.url, f"event {i}")
+
+        self.assertTrue(dispatcher.flush(10))
+        self.assertEqual([d for _, _, embeds in stub.calls for d in embeds],
+                         ["event 2", "event 3", "event 4"])
+        status = dispatcher.status()
+        self.assertEqual((status["queued"], status["sent"], status["dropped"]), (5, 3, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,10 +14,9 @@ import smtplib
 import socket
 from datetime import datetime, timezone, timedelta
 from functools import wraps
-from flask import Flask, render_template, jsonify, request, send_from_directory, session, redirect, url_for, send_file
+from flask import Flask, render_template, jsonify, request, send_from_directory, session, redirect, url_for, Response
 from flask_socketio import SocketIO, emit
 import secrets
-from plexapi.myplex import MyPlexAccount
 
 # Ensure UTF-8 encoding for stdout to handle Unicode characters
 if hasattr(sys.stdout, 'reconfigure'):
@@ -98,7 +97,7 @@ def load_plex_auth():
 def verify_plex_token(token):
     """Verify a Plex token is valid"""
     try:
-        account = MyPlexAccount(token=token)
+        account = daemon.get_plex_account(token)
         return {
             'valid': True,
             'username': account.username,
@@ -188,6 +187,8 @@ def save_env_config(config):
     
     # Reload environment
     daemon.load_env_file(CONFIG_FILE)
+    # Watchers waiting out their interval pick the new settings up now
+    daemon.watcher_wakeup.notify()
 
 # ==================== ROUTES ====================
 
@@ -226,8 +227,8 @@ def login():
                     # Try to get server name BEFORE saving to session
                     server_name = ''
                     try:
-                        account = MyPlexAccount(token=token)
-                        resources = account.resources()
+                        account = daemon.get_plex_account(token)
+                        resources = daemon.plex_account_resources(account)
                         servers = [r for r in resources if r.provides == 'server']
                         if servers:
                             server_name = servers[0].name
@@ -456,7 +457,7 @@ def api_stats():
     """Get dashboard statistics"""
     try:
         state = daemon.load_state()
-        all_users = daemon.plex_get_users()
+        all_users = daemon.plex_directory.users()
         
         welcomed = state.get('welcomed', {})
         warned = state.get('warned', {})
@@ -471,6 +472,7 @@ def api_stats():
             'active_users': len(welcomed) - len(warned),
             'warned_users': len(warned),
             'removed_users': len(removed),
+            'archived_users': daemon.state_archive().count(),
             'at_risk_users': at_risk_count,  # Will implement proper calculation
             'dry_run_mode': os.environ.get('DRY_RUN', 'true').lower() in ('true', '1', 'yes'),
             'warn_threshold': warn_days,
@@ -488,7 +490,7 @@ def api_users():
     """Get list of all users with detailed status"""
     try:
         state = daemon.load_state()
-        plex_users = daemon.plex_get_users()
+        plex_users = daemon.plex_directory.users()
         welcomed = state.get('welcomed', {})
         warned = state.get('warned', {})
         removed = state.get('removed', {})
@@ -497,6 +499,14 @@ def api_users():
         vip_names = daemon.get_vip_names()
         web_log(f"Loaded VIP names: {vip_names}", "DEBUG")
         
+        # Shared activity snapshot: one get_users and one last-watch pass for the whole page
+        try:
+            activity = daemon.user_activity_snapshot()
+        except Exception as e:
+            web_log(f"Could not load Tautulli activity: {e}", "WARNING")
+            activity = None
+        now = datetime.now(timezone.utc)
+        
         users_data = []
         
         for user in plex_users:
@@ -528,16 +538,10 @@ def api_users():
             # Get last activity
             last_watch = None
             days_inactive = None
-            try:
-                t_users = daemon.tautulli('get_users')
-                for tu in t_users:
-                    if (tu.get('email', '') or '').lower() == (user['email'] or '').lower():
-                        last_watch = daemon.tautulli_last_watch(tu.get('user_id'))
-                        if last_watch:
-                            days_inactive = (datetime.now(timezone.utc) - last_watch).days
-                        break
-            except:
-                pass
+            if activity is not None:
+                _, last_watch = activity.match(email=email, username=username)
+                if last_watch:
+                    days_inactive = (now - last_watch).days
             
             users_data.append({
                 'id': uid,
@@ -564,8 +568,7 @@ def api_users():
 def api_user_welcome(user_id):
     """Send welcome email to user"""
     try:
-        users = daemon.plex_get_users()
-        user = next((u for u in users if str(u['id']) == user_id), None)
+        user = daemon.plex_directory.get(user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -576,15 +579,13 @@ def api_user_welcome(user_id):
         if not email:
             return jsonify({'error': 'User has no email address'}), 400
         
-        daemon.send_email(email, "Access confirmed", daemon.welcome_email_html(display))
+        message_id = daemon.send_email(email, "Access confirmed", daemon.welcome_email_html(display))
         
         # Update state
-        state = daemon.load_state()
-        state['welcomed'][user_id] = datetime.now(timezone.utc).isoformat()
-        daemon.save_state(state)
+        daemon.state_manager().set_record('welcomed', user_id, datetime.now(timezone.utc).isoformat())
         
-        web_log(f"Welcome email sent to {display} ({email})", "SUCCESS")
-        return jsonify({'success': True})
+        web_log(f"Welcome email queued for {display} ({email})", "SUCCESS")
+        return jsonify({'success': True, 'queued': message_id})
     except Exception as e:
         web_log(f"Welcome email failed: {str(e)}", "ERROR")
         return jsonify({'error': str(e)}), 500
@@ -594,8 +595,7 @@ def api_user_welcome(user_id):
 def api_user_warn(user_id):
     """Send warning email to user"""
     try:
-        users = daemon.plex_get_users()
-        user = next((u for u in users if str(u['id']) == user_id), None)
+        user = daemon.plex_directory.get(user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -607,15 +607,13 @@ def api_user_warn(user_id):
         if not email:
             return jsonify({'error': 'User has no email address'}), 400
         
-        daemon.send_email(email, "Warning: Account inactivity", daemon.warn_email_html(display, days))
+        message_id = daemon.send_email(email, "Warning: Account inactivity", daemon.warn_email_html(display, days))
         
         # Update state
-        state = daemon.load_state()
-        state['warned'][user_id] = datetime.now(timezone.utc).isoformat()
-        daemon.save_state(state)
+        daemon.state_manager().set_record('warned', user_id, datetime.now(timezone.utc).isoformat())
         
-        web_log(f"Warning email sent to {display} ({email})", "SUCCESS")
-        return jsonify({'success': True})
+        web_log(f"Warning email queued for {display} ({email})", "SUCCESS")
+        return jsonify({'success': True, 'queued': message_id})
     except Exception as e:
         web_log(f"Warning email failed: {str(e)}", "ERROR")
         return jsonify({'error': str(e)}), 500
@@ -625,8 +623,7 @@ def api_user_warn(user_id):
 def api_user_remove(user_id):
     """Remove user from Plex"""
     try:
-        users = daemon.plex_get_users()
-        user = next((u for u in users if str(u['id']) == user_id), None)
+        user = daemon.plex_directory.get(user_id)
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -634,23 +631,25 @@ def api_user_remove(user_id):
         display = user['title'] or user['username'] or 'there'
         email = user['email']
         
-        # Attempt removal
-        ok = daemon.remove_friend(daemon.get_plex_account(), user_id)
+        def record_removal(ok):
+            with daemon.state_manager().transaction() as state:
+                state['removed'][user_id] = {
+                    'ok': ok,
+                    'reason': 'Manual removal via web interface',
+                    'when': datetime.now(timezone.utc).isoformat()
+                }
+                state['welcomed'].pop(user_id, None)
+                state['warned'].pop(user_id, None)
+        
+        # Attempt removal; a success is recorded before the users cache is refreshed,
+        # so the join watcher doesn't mistake it for the user leaving
+        ok = daemon.remove_friend(user_id, on_removed=lambda: record_removal(True))
+        if not ok:
+            record_removal(False)
         
         if ok and email:
             daemon.send_email(email, "Access revoked", daemon.removal_email_html(display))
         
-        # Update state
-        state = daemon.load_state()
-        state['removed'][user_id] = {
-            'ok': ok,
-            'reason': 'Manual removal via web interface',
-            'when': datetime.now(timezone.utc).isoformat()
-        }
-        state['welcomed'].pop(user_id, None)
-        state['warned'].pop(user_id, None)
-        daemon.save_state(state)
-        
         web_log(f"User removed: {display} - {'success' if ok else 'failed'}", "WARNING" if ok else "ERROR")
         return jsonify({'success': ok})
     except Exception as e:
@@ -662,10 +661,9 @@ def api_user_remove(user_id):
 def api_user_reset(user_id):
     """Reset user state (clear warnings/removals)"""
     try:
-        state = daemon.load_state()
-        state['warned'].pop(user_id, None)
-        state['removed'].pop(user_id, None)
-        daemon.save_state(state)
+        with daemon.state_manager().transaction() as state:
+            state['warned'].pop(user_id, None)
+            state['removed'].pop(user_id, None)
         
         web_log(f"User state reset for user ID {user_id}", "INFO")
         return jsonify({'success': True})
@@ -679,8 +677,7 @@ def api_user_toggle_vip(user_id):
     # Use threading lock to prevent race conditions during bulk operations
     with vip_lock:
         try:
-            users = daemon.plex_get_users()
-            user = next((u for u in users if str(u['id']) == user_id), None)
+            user = daemon.plex_directory.get(user_id)
             
             if not user:
                 return jsonify({'error': 'User not found'}), 404
@@ -721,11 +718,10 @@ def api_import_users():
     """Import all existing Plex users and mark them as welcomed"""
     try:
         # Get all Plex users
-        plex_users = daemon.plex_get_users()
+        plex_users = daemon.plex_directory.users()
         
         # Load current state
-        state = daemon.load_state()
-        welcomed = state.get('welcomed', {})
+        welcomed = daemon.state_manager().section('welcomed')
         
         # Track imported users
         imported = []
@@ -762,9 +758,10 @@ def api_import_users():
                 'email': email
             })
         
-        # Save updated state
-        state['welcomed'] = welcomed
-        daemon.save_state(state)
+        # Save only the newly imported users
+        with daemon.state_manager().transaction() as state:
+            for entry in imported:
+                state['welcomed'].setdefault(entry['id'], welcomed[entry['id']])
         
         web_log(f"Imported {len(imported)} existing Plex users, skipped {len(skipped)}", "INFO")
         
@@ -814,7 +811,8 @@ def api_test_email():
         os.environ['SMTP_FROM'] = smtp_from
         
         try:
-            daemon.send_email(email, "Plex-Auto-Prune GUI Test Email", daemon.welcome_email_html("Test User"))
+            # Sent synchronously (not queued) so the result reflects the settings under test
+            daemon.deliver_email(email, "Plex-Auto-Prune GUI Test Email", daemon.welcome_email_html("Test User"))
             web_log(f"Test email sent to {email}", "SUCCESS")
             return jsonify({'status': 'success', 'success': True})
         finally:
@@ -854,20 +852,10 @@ def api_test_discord():
         if not webhook:
             return jsonify({'error': 'Discord webhook URL required'}), 400
         
-        # Temporarily set environment for test
-        old_webhook = os.environ.get('DISCORD_WEBHOOK')
-        os.environ['DISCORD_WEBHOOK'] = webhook
-        
-        try:
-            daemon.test_discord_notifications()
-            web_log("Test Discord notifications sent", "SUCCESS")
-            return jsonify({'success': True})
-        finally:
-            # Restore original environment
-            if old_webhook:
-                os.environ['DISCORD_WEBHOOK'] = old_webhook
-            elif 'DISCORD_WEBHOOK' in os.environ:
-                del os.environ['DISCORD_WEBHOOK']
+        # Queued against the webhook under test; the dispatcher posts them in the background
+        daemon.test_discord_notifications(webhook)
+        web_log("Test Discord notifications queued", "SUCCESS")
+        return jsonify({'success': True, 'queued': 3})
                 
     except Exception as e:
         web_log(f"Discord test failed: {str(e)}", "ERROR")
@@ -1011,9 +999,7 @@ def api_import_existing_users():
 def api_skip_import():
     """Skip user import and mark first run as complete"""
     try:
-        state = daemon.load_state()
-        state['first_run_complete'] = True
-        daemon.save_state(state)
+        daemon.state_manager().set_value('first_run_complete', True)
         web_log("Skipped user import, first run marked as complete", "INFO")
         return jsonify({'success': True})
     except Exception as e:
@@ -1023,17 +1009,59 @@ def api_skip_import():
 @app.route('/api/email-history', methods=['GET'])
 @api_login_required
 def api_get_email_history():
-    """Get email send history"""
+    """
+    Get email send history, most recent first.
+    Query params: limit (max 500), cursor (next_cursor from the previous page),
+    status, recipient, since and until (ISO dates or datetimes).
+    """
     try:
-        state = daemon.load_state()
-        # Return last 100 emails, most recent first
-        history = state.get('email_history', [])[-100:]
-        history.reverse()
-        return jsonify({'emails': history, 'total': len(state.get('email_history', []))})
+        limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+        cursor = request.args.get('cursor', type=int)
+        store = daemon.email_history_store()
+        emails, next_cursor = store.query(
+            cursor=cursor,
+            limit=limit,
+            status=request.args.get('status') or None,
+            recipient=request.args.get('recipient') or None,
+            since=request.args.get('since') or None,
+            until=request.args.get('until') or None,
+        )
+        return jsonify({'emails': emails, 'next_cursor': next_cursor, 'total': store.count()})
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
     except Exception as e:
         web_log(f"Failed to retrieve email history: {str(e)}", "ERROR")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/archive', methods=['GET'])
+@api_login_required
+def api_archive_index():
+    """List archived months (users who left Plex long ago) without opening any archive"""
+    try:
+        archive = daemon.state_archive()
+        return jsonify({
+            'months': archive.months(),
+            'counts': {section: archive.count(section) for section in daemon.STATE_RECORD_SECTIONS},
+            'archive_after_days': daemon.ARCHIVE_AFTER_DAYS
+        })
+    except Exception as e:
+        web_log(f"Failed to read archive index: {str(e)}", "ERROR")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/archive/<month>', methods=['GET'])
+@api_login_required
+def api_archive_month(month):
+    """Archived records for one month (YYYY-MM), loaded on demand"""
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'Month must be YYYY-MM'}), 400
+    try:
+        return jsonify({'month': month, 'users': daemon.state_archive().load_month(month)})
+    except Exception as e:
+        web_log(f"Failed to read archive {month}: {str(e)}", "ERROR")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/first-run/status', methods=['GET'])
 def api_first_run_status():
     """Check if this is the first run"""
@@ -1042,7 +1070,7 @@ def api_first_run_status():
         return jsonify({
             'is_first_run': not state.get('first_run_complete', False),
             'welcomed_count': len(state.get('welcomed', {})),
-            'email_count': len(state.get('email_history', []))
+            'email_count': daemon.email_history_store().count()
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1054,11 +1082,28 @@ def api_daemon_status():
     try:
         return jsonify({
             'enabled': daemon.daemon_enabled,
-            'dry_run': os.environ.get('DRY_RUN', 'true').lower() in ('true', '1', 'yes')
+            'dry_run': os.environ.get('DRY_RUN', 'true').lower() in ('true', '1', 'yes'),
+            'http_pool': daemon.http_pool_stats(),
+            'smtp_pool': daemon.smtp_pool().status(),
+            'mail_queue': daemon.mail_queue().status(),
+            'smtp_rate_limit': daemon.smtp_limiter.status(),
+            'discord': daemon.discord_dispatcher.status(),
+            'notifications': daemon.notification_bus.status(),
+            'inactivity_scheduler': daemon.inactivity_scheduler.status(),
+            'admin_notify': {'mode': daemon.ADMIN_NOTIFY_MODE, 'pending': daemon.admin_notifier.pending()}
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/mail-queue', methods=['GET'])
+@api_login_required
+def api_mail_queue():
+    """Outbound mail queue depth, age of the oldest message, delivery counters and SMTP throttle state"""
+    try:
+        return jsonify(dict(daemon.mail_queue().status(), rate_limit=daemon.smtp_limiter.status()))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/daemon/start', methods=['POST'])
 @api_login_required
 def api_daemon_start():
@@ -1083,60 +1128,66 @@ def api_daemon_stop():
         web_log(f"Failed to disable daemon: {str(e)}", "ERROR")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/daemon/scan', methods=['POST'])
+@api_login_required
+def api_daemon_scan():
+    """Run the join and/or inactivity checks now instead of at their next interval"""
+    try:
+        watcher = (request.json or {}).get('watcher', 'all') if request.is_json else request.args.get('watcher', 'all')
+        watchers = daemon.WatcherWakeup.WATCHERS if watcher == 'all' else (watcher,)
+        if any(w not in daemon.WatcherWakeup.WATCHERS for w in watchers):
+            return jsonify({'error': "watcher must be 'join', 'inactive' or 'all'"}), 400
+        if not daemon.daemon_enabled:
+            return jsonify({'error': 'Daemon monitoring is disabled'}), 409
+        daemon.watcher_wakeup.request_scan(watchers)
+        web_log(f"Scan requested by user: {', '.join(watchers)}", "INFO")
+        return jsonify({'success': True, 'watchers': list(watchers)})
+    except Exception as e:
+        web_log(f"Failed to request scan: {str(e)}", "ERROR")
+        return jsonify({'error': str(e)}), 500
+
 # ==================== BACKUP & RESTORE ====================
 
 @app.route('/api/backup', methods=['GET'])
 @api_login_required
 def api_backup():
-    """Create and download a backup of configuration and state"""
-    import zipfile
-    import io
-    from datetime import datetime
-    
+    """
+    Stream a backup ZIP of configuration and state.
+    ?since=<backup id> produces an incremental backup of changes since that backup.
+    """
     try:
-        # Create in-memory ZIP file
-        zip_buffer = io.BytesIO()
+        base_id = request.args.get('since') or None
+        backup_id, chunks = daemon.stream_backup(base_id=base_id, env_path='.env')
+        kind = 'incremental' if base_id else 'full'
+        web_log(f"Streaming {kind} backup {backup_id}", "INFO")
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Add .env file if it exists
-            if os.path.exists('.env'):
-                zip_file.write('.env', 'config.env')
-            
-            # Add state.json if it exists
-            state_path = os.path.join('state', 'state.json')
-            if os.path.exists(state_path):
-                zip_file.write(state_path, 'state.json')
-            
-            # Add a backup manifest
-            manifest = {
-                'backup_date': datetime.now().isoformat(),
-                'version': '1.0',
-                'files': ['config.env', 'state.json']
-            }
-            import json
-            zip_file.writestr('manifest.json', json.dumps(manifest, indent=2))
-        
-        zip_buffer.seek(0)
-        
-        web_log("Configuration backup created", "INFO")
-        
-        return send_file(
-            zip_buffer,
+        return Response(
+            chunks,
             mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'guardian-backup-{datetime.now().strftime("%Y%m%d-%H%M%S")}.zip'
+            headers={
+                'Content-Disposition': f'attachment; filename=guardian-backup-{backup_id}.zip',
+                'X-Backup-Id': backup_id
+            }
         )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         web_log(f"Backup failed: {str(e)}", "ERROR")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/backups', methods=['GET'])
+@api_login_required
+def api_backups():
+    """List completed backups that can serve as the base of an incremental backup"""
+    try:
+        return jsonify({'backups': daemon.backup_catalogs()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/restore', methods=['POST'])
 @api_login_required
 def api_restore():
-    """Restore configuration and state from backup"""
-    import zipfile
-    import tempfile
-    
+    """Restore configuration and state from a full or incremental backup"""
     try:
         if 'backup' not in request.files:
             return jsonify({'status': 'error', 'message': 'No backup file provided'}), 400
@@ -1146,30 +1197,11 @@ def api_restore():
         if not backup_file.filename.endswith('.zip'):
             return jsonify({'status': 'error', 'message': 'Invalid file type. Must be a .zip file'}), 400
         
-        # Create temporary directory for extraction
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save uploaded file
-            temp_zip = os.path.join(temp_dir, 'backup.zip')
-            backup_file.save(temp_zip)
-            
-            # Extract ZIP
-            with zipfile.ZipFile(temp_zip, 'r') as zip_file:
-                zip_file.extractall(temp_dir)
-            
-            # Restore .env
-            config_file = os.path.join(temp_dir, 'config.env')
-            if os.path.exists(config_file):
-                import shutil
-                shutil.copy(config_file, '.env')
-                web_log("Configuration restored from backup", "INFO")
-            
-            # Restore state.json
-            state_backup = os.path.join(temp_dir, 'state.json')
-            if os.path.exists(state_backup):
-                import shutil
-                os.makedirs('state', exist_ok=True)
-                shutil.copy(state_backup, os.path.join('state', 'state.json'))
-                web_log("User state restored from backup", "INFO")
+        # Entries are read from the uploaded file and validated before anything is applied
+        summary = daemon.restore_backup(backup_file.stream, env_path='.env')
+        web_log(f"Restored {summary['type']} backup: state={summary['state']}, "
+                f"config={summary['config']}, archive files={summary['archive_files']}, "
+                f"new emails={summary['emails']}", "INFO")
         
         # Restart daemon to pick up new configuration
         daemon.save_daemon_control(False)
@@ -1177,8 +1209,12 @@ def api_restore():
         
         return jsonify({
             'status': 'success',
-            'message': 'Backup restored successfully. Daemon restarting...'
+            'message': 'Backup restored successfully. Daemon restarting...',
+            'summary': summary
         })
+    except ValueError as e:
+        web_log(f"Restore rejected: {str(e)}", "ERROR")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         web_log(f"Restore failed: {str(e)}", "ERROR")
         return jsonify({'status': 'error', 'message': str(e)}), 500